@@ -12,6 +12,16 @@ __email__ = "ds4n6@one-esecurity.com"
 import os
 import sys
 import argparse
+import re
+import glob
+import json
+import shutil
+import hashlib
+import itertools
+import importlib.util
+import concurrent.futures
+from collections import Counter
+from collections.abc import Mapping
 import xml.etree.ElementTree as et
 import Evtx.Evtx as evtx
 import Evtx.Views as e_views
@@ -21,25 +31,218 @@ from tqdm import tqdm
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.colors import LogNorm
 import numpy  as np
 import pandas as pd
 
+evtx_ns = {"xml": "http://schemas.microsoft.com/win/2004/08/events/event"}
+
+# Namespaced tags, resolved once instead of per element
+evtx_tag_event = '{http://schemas.microsoft.com/win/2004/08/events/event}Event'
+evtx_tag_system = '{http://schemas.microsoft.com/win/2004/08/events/event}System'
+evtx_tag_eventdata = '{http://schemas.microsoft.com/win/2004/08/events/event}EventData'
+evtx_tag_data = '{http://schemas.microsoft.com/win/2004/08/events/event}Data'
+evtx_tag_userdata = '{http://schemas.microsoft.com/win/2004/08/events/event}UserData'
+# Field names of the tags seen so far: {tag: name}
+evtx_system_names = {}
+evtx_userdata_names = {}
+
+evtx_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "ds4n6", "evtx")
+
+evtx_re_evtid = re.compile(r'<EventID[^>]*>\s*(\d+)\s*</EventID>')
+evtx_re_systime = re.compile(r'<TimeCreated SystemTime="([^"]*)"')
+evtx_re_channel = re.compile(r'<Channel>([^<]*)</Channel>')
+evtx_re_evtid_text = re.compile(r'<EventID[^>]*>([^<]*)</EventID>')
+evtx_re_substitution = re.compile(r'\[(?:Normal|Conditional) Substitution\(index=(\d+), type=\d+\)\]$')
+evtx_re_date = re.compile(r'\s*(\d{4})(?:[-/](\d{1,2})(?:[-/](\d{1,2})(?:[ T](\d{1,2})(?::(\d{1,2})(?::(\d{1,2})(\.\d+)?)?)?)?)?)?\s*$')
+
 def evtx_xml(evtxf):
 
     print("  + EVTX -> XML")
     
     thistr = ''
     with evtx.Evtx(evtxf) as log:
-        thistr = e_views.XML_HEADER
-        thistr = thistr + '<Events>'
+        xmls = [e_views.XML_HEADER, '<Events>']
         for record in tqdm(log.records()):
-            thistr = thistr + record.xml()
-        thistr = thistr + '</Events>'
+            xmls.append(record.xml())
+        xmls.append('</Events>')
+        thistr = ''.join(xmls)
 
     return thistr
 
 
-def evtx_new_xml_parse(evtxxmlf, file=False):
+def evtx_event_row(node):
+    """
+    Convert an <Event> element into a row dict (System, EventData & UserData fields).
+    """
+    default_data = {}
+    for nodes in node:
+        if nodes.tag == evtx_tag_system:
+            for nodesc in nodes:
+                name = evtx_system_names.get(nodesc.tag)
+                if name is None:
+                    name = evtx_system_names[nodesc.tag] = nodesc.tag.replace('{http://schemas.microsoft.com/win/2004/08/events/event}', '')
+                if nodesc.text:
+                    default_data[name] = nodesc.text
+                for attr, value in nodesc.attrib.items():
+                    default_data[name + "_" + attr] = value
+        elif nodes.tag == evtx_tag_eventdata:
+            for nodedd in nodes:
+                if nodedd.tag == evtx_tag_data:
+                    default_data[nodedd.attrib["Name"]] = nodedd.text
+        elif nodes.tag == evtx_tag_userdata:
+            for nodeuu in nodes:
+                name = evtx_userdata_names.get(nodeuu.tag)
+                if name is None:
+                    name = evtx_userdata_names[nodeuu.tag] = nodeuu.tag.replace('{http://manifests.microsoft.com/win/2004/08/windows/eventlog}', '')
+                default_data[name] = nodeuu.text
+
+    return default_data
+
+
+def evtx_filter_date(date):
+    """
+    Normalize a (maybe partial) date to the zero-padded "YYYY-MM-DD HH:MM:SS"
+    prefix of the same precision ("2020-1-5" -> "2020-01-05"), so records can
+    be compared with it as strings. None if it can't be normalized.
+    """
+    match = evtx_re_date.match(str(date))
+    if match is None:
+        return None
+    fields = [int(field) for field in match.groups()[:6] if field is not None]
+    try:
+        timestamp = pd.Timestamp(*(fields + [1, 1, 0, 0, 0][len(fields) - 1:]))
+    except ValueError:
+        return None
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S')[:[4, 7, 10, 13, 16, 19][len(fields) - 1]] + (match.group(7) or '')
+
+
+def evtx_filter(evtids=None, start=None, end=None, channels=None):
+    """
+    Build a record filter for the parsers: the EventIDs, channels and
+    TimeCreated window [start, end] to keep. Dates may be partial ("2020-01"),
+    like in the analyses' .loc[firstdate:lastdate] (end is inclusive). When
+    they can't be normalized (see evtx_filter_date()) the window is not used,
+    the analyses still apply it. Returns None when nothing is filtered.
+    """
+    start = evtx_filter_date(start) if start else None
+    end = evtx_filter_date(end) if end else None
+    if start is None or end is None:
+        start = end = None
+    if not (evtids or start or end or channels):
+        return None
+
+    return {
+        'evtids': set(int(evtid) for evtid in evtids) if evtids else None,
+        'start': start,
+        'end': end,
+        'channels': set(channels) if channels else None,
+    }
+
+
+def evtx_match(evtid, systime, channel, evtfilter):
+    if evtfilter['evtids'] is not None and (evtid is None or int(evtid) not in evtfilter['evtids']):
+        return False
+    if evtfilter['channels'] is not None and channel not in evtfilter['channels']:
+        return False
+    if evtfilter['start'] or evtfilter['end']:
+        # Compare as strings, truncated to the precision of the bounds
+        systime = (systime or '').replace('T', ' ')
+        if evtfilter['start'] and systime[:len(evtfilter['start'])] < evtfilter['start']:
+            return False
+        if evtfilter['end'] and systime[:len(evtfilter['end'])] > evtfilter['end']:
+            return False
+    return True
+
+
+def evtx_xml_match(xml, evtfilter):
+    """
+    Check a record's XML string against evtfilter before parsing it.
+    """
+    evtid = evtx_re_evtid.search(xml)
+    systime = evtx_re_systime.search(xml)
+    channel = evtx_re_channel.search(xml)
+    return evtx_match(evtid and evtid.group(1), systime and systime.group(1), channel and channel.group(1), evtfilter)
+
+
+def evtx_template_fields(root):
+    """
+    Where the EventID, SystemTime & Channel of the records of a template are:
+    a substitution index or a literal value each (None if not in the template).
+    Returns None when the template can't be read this way.
+    """
+    try:
+        view = e_views.evtx_template_readable_view(root)
+    except Exception:
+        return None
+    fields = []
+    for regex in (evtx_re_evtid_text, evtx_re_systime, evtx_re_channel):
+        found = regex.search(view)
+        sub = found and evtx_re_substitution.match(found.group(1))
+        fields.append(int(sub.group(1)) if sub else found and found.group(1))
+    return fields
+
+
+def evtx_records_xml(chunks, evtfilter=None):
+    """
+    Yield the XML of the records of chunks matching evtfilter. The EventID,
+    SystemTime & Channel are read from the substitutions of each record, so
+    the ones not matching are skipped before their XML is rendered.
+    """
+    for chunk in chunks:
+        # Template offsets are relative to their chunk
+        templates = {}
+        for record in chunk.records():
+            if evtfilter is None:
+                yield record.xml()
+                continue
+            root = record.root()
+            offset = root.template_instance().template_offset()
+            if offset not in templates:
+                templates[offset] = evtx_template_fields(root)
+            fields = templates[offset]
+            if fields is None:
+                xml = record.xml()
+                if evtx_xml_match(xml, evtfilter):
+                    yield xml
+                continue
+            subs = root.substitutions()
+            values = [(subs[field].string() if field < len(subs) else None) if isinstance(field, int) else field
+                      for field in fields]
+            if evtx_match(values[0] or None, values[1], values[2], evtfilter):
+                yield e_views.render_root_node(root)
+
+
+def evtx_event_match(node, evtfilter, ns=evtx_ns):
+    """
+    Check an <Event> element against evtfilter before converting it into a row.
+    """
+    timecreated = node.find("./xml:System/xml:TimeCreated", ns)
+    return evtx_match(node.findtext("./xml:System/xml:EventID", None, ns),
+                      timecreated.get("SystemTime") if timecreated is not None else None,
+                      node.findtext("./xml:System/xml:Channel", None, ns), evtfilter)
+
+
+def evtx_filter_df(evtdf, evtfilter):
+    """
+    Apply the EventID & channel parts of evtfilter to an already parsed dataframe
+    (the time window is applied by the analyses themselves).
+    """
+    if evtfilter is None:
+        return evtdf
+
+    mask = pd.Series(True, index=evtdf.index)
+    if evtfilter['evtids'] is not None:
+        mask &= evtdf['EventID'].isin(evtfilter['evtids'])
+    if evtfilter['channels'] is not None and 'Channel' in evtdf.columns:
+        mask &= evtdf['Channel'].isin(evtfilter['channels'])
+    if mask.all():
+        return evtdf
+    return evtdf[mask].reset_index(drop=True)
+
+
+def evtx_new_xml_parse(evtxxmlf, file=False, verbose=True, evtfilter=None):
     ns = {"xml": "http://schemas.microsoft.com/win/2004/08/events/event"}
 
     et.register_namespace("xml", "http://schemas.microsoft.com/win/2004/08/events/event")
@@ -53,89 +256,733 @@ def evtx_new_xml_parse(evtxxmlf, file=False):
         tree = et.ElementTree(et.fromstring(evtxxmlf))
         msg = "  + Parsing XML from Memory"
     
-    print(msg)
+    if verbose:
+        print(msg)
         
     root = tree.getroot()
     rows = []
 
-    evtfull = pd.DataFrame()
+    for node in tqdm(root.findall("./xml:Event", ns), disable=not verbose):
+        if evtfilter is not None and not evtx_event_match(node, evtfilter, ns):
+            continue
+        rows.append(evtx_event_row(node))
 
-    for node in tqdm(root.findall("./xml:Event", ns)):
-        default_data = {}
-        for nodes in node.findall("./xml:System", ns):
-            for nodesc in nodes.getchildren():
-                if nodesc.text:
-                    default_data[
-                        nodesc.tag.replace('{http://schemas.microsoft.com/win/2004/08/events/event}', '')] = nodesc.text
-                if nodesc.attrib.items():
-                    for nodesca in nodesc.attrib.items():
-                        default_data[
-                            nodesc.tag.replace('{http://schemas.microsoft.com/win/2004/08/events/event}', '') + "_" +
-                            nodesca[0]] = nodesca[1]
-        for noded in node.findall("./xml:EventData", ns):
-            for nodedd in noded.findall("./xml:Data", ns):
-                default_data[
-                    nodedd.attrib["Name"].replace('{http://manifests.microsoft.com/win/2004/08/windows/eventlog}',
-                                                  '')] = nodedd.text
-        for nodeu in node.findall("./xml:UserData", ns):
-            for nodeuu in nodeu.getchildren():
-                default_data[nodeuu.tag.replace('{http://manifests.microsoft.com/win/2004/08/windows/eventlog}',
-                                                '')] = nodeuu.text
-
-        rows.append(default_data)
-
-    evtfull = evtfull.append(rows)
+    evtfull = pd.DataFrame(rows)
 
     return evtfull
 
-def evtx2df(evtxf, evtsave=""):
-    import tempfile
+
+def evtx_xml_rows(evtxxmlf, verbose=True, evtfilter=None):
+    """
+    Yield one row dict per <Event> of an exported XML file. The file is parsed
+    incrementally and each event is freed once converted, so memory stays flat.
+    """
+    if verbose:
+        print("  + Reading from XML File")
+
+    context = et.iterparse(evtxxmlf, events=('start', 'end'))
+    _, root = next(context)
+    with tqdm(disable=not verbose) as progress:
+        for event, node in context:
+            if event == 'end' and node.tag == evtx_tag_event:
+                if evtfilter is None or evtx_event_match(node, evtfilter):
+                    yield evtx_event_row(node)
+                # Drop the events already converted
+                root.clear()
+                progress.update()
+
+
+def evtx_records_rows(evtxf, verbose=True, evtfilter=None):
+    """
+    Yield one row dict per EVTX record, parsing the XML of each record on its own
+    (no full-file XML string or DOM is ever built). Records not matching
+    evtfilter are skipped before they are rendered (see evtx_records_xml()).
+    """
+    if verbose:
+        print("  + Parsing EVTX records")
+
+    with evtx.Evtx(evtxf) as log:
+        for xml in tqdm(evtx_records_xml(log.chunks(), evtfilter), disable=not verbose):
+            yield evtx_event_row(et.fromstring(xml))
+
+
+def evtx_rows2df(rows, batch_size=100000):
+    """
+    Build a dataframe from an iterable of row dicts, converting them to
+    columns every batch_size rows so only one batch of dicts is alive at a time.
+    """
+    batches = []
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            batches.append(pd.DataFrame(batch))
+            batch = []
+    if batch or not batches:
+        batches.append(pd.DataFrame(batch))
+
+    if len(batches) == 1:
+        return batches[0]
+    return pd.concat(batches, ignore_index=True, sort=False)
+
+
+def evtx_nchunks(evtxf):
+    with evtx.Evtx(evtxf) as log:
+        return log.get_file_header().chunk_count()
+
+
+def evtx_chunks_df(evtxf, first_chunk, last_chunk, batch_size=100000, evtfilter=None):
+    """
+    Parse the records of chunks [first_chunk, last_chunk) into a dataframe.
+    Runs in the worker processes of evtx2df_parallel().
+    """
+    with evtx.Evtx(evtxf) as log:
+        chunks = itertools.islice(log.chunks(), first_chunk, last_chunk)
+        rows = (evtx_event_row(et.fromstring(xml)) for xml in evtx_records_xml(chunks, evtfilter))
+        return evtx_rows2df(rows, batch_size=batch_size)
+
+
+def evtx2df_parallel(evtxf, workers, batch_size=100000, evtfilter=None):
+    """
+    Convert evtx file to dataframe, spreading its 64 KB chunks across a pool of
+    worker processes. Partial results are merged in chunk (i.e. record) order.
+    """
+    nchunks = evtx_nchunks(evtxf)
+    # Several chunk ranges per worker, so one slow range does not leave the others idle
+    step = max(1, -(-nchunks // (workers * 4)))
+    ranges = [(first, min(first + step, nchunks)) for first in range(0, nchunks, step)]
+
+    print("  + Parsing %d EVTX chunks with %d workers" % (nchunks, workers))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(evtx_chunks_df, evtxf, first, last, batch_size, evtfilter) for first, last in ranges]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            future.result()
+        parts = [future.result() for future in futures]
+
+    if not parts:
+        return pd.DataFrame()
+    return pd.concat(parts, ignore_index=True, sort=False)
+
+
+def evtx2df(evtxf, evtsave="", batch_size=100000, workers=1, verbose=True, evtfilter=None):
     """
     Convert evtx file to dataframe.
     """
-    print("  + Executing evtx to dataframe...")
+    if verbose:
+        print("  + Executing evtx to dataframe...")
     
     if evtsave:
-        evtdf = evtx_new_xml_parse(evtxf,True)
+        evtdf = evtx_rows2df(evtx_xml_rows(evtxf, verbose=verbose, evtfilter=evtfilter), batch_size=batch_size)
+    elif workers > 1:
+        evtdf = evtx2df_parallel(evtxf, workers, batch_size=batch_size, evtfilter=evtfilter)
     else:
-        evtdf = evtx_new_xml_parse(evtx_xml(evtxf))            
+        evtdf = evtx_rows2df(evtx_records_rows(evtxf, verbose=verbose, evtfilter=evtfilter), batch_size=batch_size)
 
     return evtdf
 
-def read_evtx(evtxf,verbose=True):
-    import os
-    
-    filename, file_extension = os.path.splitext(evtxf)
-    if file_extension == ".evtx":
-        evtalldf=evtx2df(evtxf)
-    else:
-        # True - .xml file
-        evtalldf=evtx2df(evtxf,True)
+def evtx_cache_key(evtxf):
+    """
+    Cache key of a parsed file: path, size, mtime and a digest of its content.
+    For .evtx files the digest covers the file header and every chunk header
+    (which carry the chunk data checksums) instead of the whole file.
+    """
+    st = os.stat(evtxf)
+    keyh = hashlib.sha1()
+    keyh.update(("%s|%d|%d|" % (os.path.abspath(evtxf), st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    with open(evtxf, 'rb') as f:
+        if evtxf.endswith('.evtx'):
+            keyh.update(f.read(0x1000))
+            for ofs in range(0x1000, st.st_size, 0x10000):
+                f.seek(ofs)
+                keyh.update(f.read(0x200))
+        else:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                keyh.update(block)
+
+    return keyh.hexdigest()
+
+
+def evtx_cache_file(evtxf, cache_dir=evtx_cache_dir):
+    return os.path.join(cache_dir, evtx_cache_key(evtxf) + ".parquet")
+
+
+def evtx_cache_load(cachef, verbose=True):
+    """
+    Return the dataframe cached in cachef, or None if it is not cached.
+    """
+    if not os.path.exists(cachef):
+        return None
+
+    if verbose:
+        print("  + Reading from cache " + cachef)
+    try:
+        evtdf = pd.read_parquet(cachef)
+    except ImportError as e:
+        print("  - Cache disabled: " + str(e))
+        return None
+    except FileNotFoundError:
+        # Evicted by another process in the meantime
+        return None
+    # Keep track of the last use for the LRU eviction
+    try:
+        os.utime(cachef)
+    except FileNotFoundError:
+        pass
+
+    return evtdf
+
+
+def evtx_cache_save(evtdf, cachef, cache_max_size=10240, verbose=True):
+    """
+    Save the dataframe to cachef, then evict the least recently used entries
+    of its cache directory until the cache is under cache_max_size MB.
+    """
+    cache_dir = os.path.dirname(cachef)
+    os.makedirs(cache_dir, exist_ok=True)
+    if verbose:
+        print("  + Saving to cache " + cachef)
+    # One temporary file per process, several may be saving the same file
+    tmpf = "%s.%d.tmp" % (cachef, os.getpid())
+    try:
+        evtdf.to_parquet(tmpf)
+    except ImportError as e:
+        print("  - Cache disabled: " + str(e))
+        return
+    os.replace(tmpf, cachef)
+    # A search index built from a previous parse is no longer valid
+    try:
+        os.remove(evtx_search_index_file(cachef))
+    except FileNotFoundError:
+        pass
+
+    # Evict whole entries (parsed file + search index), least recently used first.
+    # Other processes (e.g. the workers of read_evtx_batch()) may be evicting from
+    # the same cache directory, so the files already gone are skipped
+    entries = []
+    for f in glob.glob(os.path.join(cache_dir, "*.parquet")):
+        try:
+            entryfs = [(entryf, os.path.getsize(entryf)) for entryf in glob.glob(f[:-len(".parquet")] + ".*")
+                       if not entryf.endswith(".tmp")]
+            entries.append((os.path.getmtime(f), f, entryfs))
+        except FileNotFoundError:
+            continue
+    entries.sort()
+    cache_size = sum(size for _, _, entryfs in entries for _, size in entryfs)
+    for _, oldf, entryfs in entries:
+        if cache_size <= cache_max_size * 1024 * 1024 or oldf == cachef:
+            break
+        for f, size in entryfs:
+            cache_size -= size
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+
+def evtx_df_types(evtalldf):
+    if evtalldf.empty:
+        evtalldf = pd.DataFrame(columns=['EventID', 'TimeCreated_SystemTime'])
 
-    dfs={}
-    dfs["all"]=evtalldf
     # Ok, the "System_TimeCreated_SystemTime" column is "object" and should be of type "datetime", so let's change it
     evtalldf['TimeCreated_SystemTime']=pd.to_datetime(evtalldf['TimeCreated_SystemTime'])
     # The same happens with "System_EventID_VALUE" which should be an integer    
     evtalldf['EventID']=evtalldf['EventID'].astype(int)
 
+    return evtalldf
+
+
+def evtx_record_time(chunks, ranges, record_num, chunk=None):
+    """
+    Timestamp (isoformat) of record record_num, looked up in chunk first.
+    None when the record is no longer in the log.
+    """
+    candidates = ([chunk] if chunk is not None and chunk < len(chunks) else []) + list(range(len(chunks)))
+    for i in candidates:
+        if ranges[i][0] <= record_num <= ranges[i][1]:
+            for record in chunks[i].records():
+                if record.record_num() == record_num:
+                    return record.timestamp().isoformat()
+    return None
+
+
+def read_evtx_incremental(evtxf,state_dir=os.path.join(evtx_cache_dir, "incremental"),verbose=True,batch_size=100000):
+    """
+    Read a live .evtx file that is collected again and again (e.g. every hour).
+
+    The events already ingested are kept in state_dir (one Parquet part per run),
+    together with the highest EventRecordID ingested, the chunk holding it and
+    its timestamp. Later runs only parse the chunks with newer records (checked
+    on the chunk headers), in record order even when the log has wrapped around.
+    If the log was cleared or replaced (its records are older than the ones
+    ingested, or the last record ingested has another timestamp now) it is read
+    again from scratch.
+
+    Returns:
+    pd.DataFrame: All the events ingested from the file so far
+    """
+    sourcef = os.path.abspath(evtxf)
+    sourced = os.path.join(state_dir, hashlib.sha1(sourcef.encode('utf-8')).hexdigest())
+    statef = os.path.join(sourced, "state.json")
+    state = {'source': sourcef, 'last_record': 0, 'last_chunk': None, 'last_time': None, 'parts': 0}
+    if os.path.exists(statef):
+        with open(statef) as f:
+            state = json.load(f)
+
+    with evtx.Evtx(evtxf) as log:
+        chunks = list(log.chunks())
+        ranges = [(chunk.log_first_record_number(), chunk.log_last_record_number()) for chunk in chunks]
+        used = [i for i, (first, last) in enumerate(ranges) if 0 < first <= last]
+
+        first_record = min(ranges[i][0] for i in used) if used else 0
+        last_record = max(ranges[i][1] for i in used) if used else 0
+        # A log cleared and written again past the last record ingested is told by
+        # the timestamp of that record (if it was not overwritten since)
+        replaced = state['last_record'] > last_record
+        if not replaced and state['last_record'] and state.get('last_time'):
+            last_time = evtx_record_time(chunks, ranges, state['last_record'], state['last_chunk'])
+            replaced = last_time is not None and last_time != state['last_time']
+        if replaced:
+            print("  - " + evtxf + " was cleared or replaced since the last run, reading it again")
+            shutil.rmtree(sourced)
+            state = {'source': sourcef, 'last_record': 0, 'last_chunk': None, 'last_time': None, 'parts': 0}
+        elif state['last_record'] and first_record > state['last_record'] + 1:
+            print("  - %d records of %s were overwritten before being ingested" % (first_record - state['last_record'] - 1, evtxf))
+
+        # Chunks with newer records, oldest first (the log is a ring of chunks, so
+        # after a wrap-around the newest records are in the first chunks of the file)
+        newchunks = sorted((i for i in used if ranges[i][1] > state['last_record']), key=lambda i: ranges[i][0])
+
+        if verbose:
+            print("  + Parsing %d new chunks of %d (records after %d)" % (len(newchunks), len(chunks), state['last_record']))
+
+        new_last = {'record': state['last_record'], 'chunk': state['last_chunk'], 'time': state.get('last_time')}
+
+        def newrows():
+            for i in tqdm(newchunks, disable=not verbose):
+                for record in chunks[i].records():
+                    record_num = record.record_num()
+                    if record_num <= state['last_record']:
+                        continue
+                    if record_num > new_last['record']:
+                        new_last['record'], new_last['chunk'] = record_num, i
+                        new_last['time'] = record.timestamp().isoformat()
+                    yield evtx_event_row(et.fromstring(record.xml()))
+
+        newdf = evtx_rows2df(newrows(), batch_size=batch_size)
+
+    os.makedirs(sourced, exist_ok=True)
+    if not newdf.empty:
+        state['parts'] += 1
+        evtx_df_types(newdf).to_parquet(os.path.join(sourced, "part-%06d.parquet" % state['parts']))
+    state['last_record'], state['last_chunk'], state['last_time'] = new_last['record'], new_last['chunk'], new_last['time']
+    with open(statef + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(statef + ".tmp", statef)
+
+    if verbose:
+        print("  + %d new events, up to EventRecordID %d" % (len(newdf), state['last_record']))
+
+    partsfs = sorted(glob.glob(os.path.join(sourced, "part-*.parquet")))
+    if not partsfs:
+        return evtx_df_types(pd.DataFrame())
+    return pd.concat([pd.read_parquet(f) for f in partsfs], ignore_index=True, sort=False)
+
+
+def read_evtx_all(evtxf,verbose=True,batch_size=100000,workers=1,cache=False,rebuild_cache=False,cache_dir=evtx_cache_dir,cache_max_size=10240,evtfilter=None,incremental=False):
+    """
+    Read an .evtx (or exported .xml) file into a single dataframe with typed
+    TimeCreated_SystemTime and EventID columns, going through the cache if enabled.
+    Records not matching evtfilter (see evtx_filter()) are skipped while parsing;
+    filtered results are not cached, but a cached full parse is used to answer them.
+    With incremental, .evtx files are read with read_evtx_incremental() instead.
+    """
+    if incremental and evtxf.endswith('.evtx'):
+        evtalldf = read_evtx_incremental(evtxf, os.path.join(cache_dir, "incremental"), verbose=verbose, batch_size=batch_size)
+        return evtx_filter_df(evtalldf, evtfilter)
+
+    if cache:
+        cachef = evtx_cache_file(evtxf, cache_dir)
+        if not rebuild_cache:
+            evtalldf = evtx_cache_load(cachef, verbose=verbose)
+            if evtalldf is not None:
+                return evtx_filter_df(evtalldf, evtfilter)
+
+    filename, file_extension = os.path.splitext(evtxf)
+    if file_extension == ".evtx":
+        evtalldf=evtx2df(evtxf,batch_size=batch_size,workers=workers,verbose=verbose,evtfilter=evtfilter)
+    else:
+        # True - .xml file
+        evtalldf=evtx2df(evtxf,True,batch_size=batch_size,verbose=verbose,evtfilter=evtfilter)
+
+    evtalldf = evtx_df_types(evtalldf)
+
+    if cache and evtfilter is None:
+        evtx_cache_save(evtalldf, cachef, cache_max_size, verbose=verbose)
+
+    return evtalldf
+
+
+class EvtxDfs(Mapping):
+    """
+    Lazy {EventID: dataframe} mapping over the events dataframe. The rows of
+    every EventID are located with a single groupby, and each per-EventID
+    dataframe is only built (and kept) the first time it is accessed.
+    dfs['all'] is the dataframe with every event.
+    """
+
+    def __init__(self, evtalldf):
+        self.evtalldf = evtalldf
+        self.indices = evtalldf.groupby('EventID', sort=True).indices
+        self.dfs = {}
+
+    def __getitem__(self, evtid):
+        if isinstance(evtid, str) and evtid == "all":
+            return self.evtalldf
+        if evtid not in self.dfs:
+            evtdf = self.evtalldf.iloc[self.indices[evtid]].dropna(axis=1,how='all')
+            # Event-specific tuning
+            if evtid == 4624:
+                evtdf['LogonType']=evtdf['LogonType'].astype(int)
+            self.dfs[evtid] = evtdf
+        return self.dfs[evtid]
+
+    def __contains__(self, evtid):
+        return (isinstance(evtid, str) and evtid == "all") or evtid in self.indices
+
+    def __iter__(self):
+        yield "all"
+        yield from self.indices
+
+    def __len__(self):
+        return len(self.indices) + 1
+
+
+def evtx_dfs(evtalldf,verbose=True):
+    """
+    Split the events dataframe into one dataframe per EventID (built on first access).
+    dfs['all'] keeps every event.
+    """
+    dfs = EvtxDfs(evtalldf)
+
     if verbose == True:
         print("\n")
         print("Generating pandas dataframes: ")
-    evtids=pd.Series(evtalldf['EventID']).drop_duplicates().sort_values(ascending=True)
-    for evtid in evtids:
-        if verbose == True:
-            print('- %-10s ... ' % (evtid),end='')
-        dfs[evtid]=evtalldf.query('EventID == @evtid').dropna(axis=1,how='all')
-        if verbose == True:
-            print(' [%s]' % (str(len(dfs[evtid]))))
-        # Event-specific tuning
-        if evtid == 4624:
-            dfs[evtid]['LogonType']=dfs[evtid]['LogonType'].astype(int)    
+        for evtid, positions in dfs.indices.items():
+            print('- %-10s ...  [%s]' % (evtid, str(len(positions))))
 
     return dfs
 
 
+def read_evtx(evtxf,verbose=True,batch_size=100000,workers=1,cache=False,rebuild_cache=False,cache_dir=evtx_cache_dir,cache_max_size=10240,evtfilter=None,compact=False,incremental=False):
+    evtalldf = read_evtx_all(evtxf, verbose=verbose, batch_size=batch_size, workers=workers,
+                             cache=cache, rebuild_cache=rebuild_cache, cache_dir=cache_dir, cache_max_size=cache_max_size,
+                             evtfilter=evtfilter, incremental=incremental)
+    if compact:
+        evtalldf = evtx_compact(evtalldf, verbose=verbose)
+
+    return evtx_dfs(evtalldf, verbose=verbose)
+
+
+def evtx_compact(evtdf, max_cardinality=0.5, verbose=True):
+    """
+    Shrink the events dataframe in place: fields holding integers are
+    downcast to the smallest integer type, low-cardinality fields (Computer,
+    Channel, Provider_Name, LogonType, ...) become categoricals and the
+    remaining strings are stored in Arrow (if pyarrow is installed).
+
+    Parameters:
+    evtdf (pd.DataFrame): Events
+    max_cardinality (float): Ratio of distinct values to rows under which a field becomes a categorical
+    verbose (bool): Print the memory saved per column
+
+    Returns:
+    pd.DataFrame: The compacted dataframe
+    """
+    strdtype = "string[pyarrow]" if importlib.util.find_spec("pyarrow") is not None else None
+
+    if verbose:
+        print("\nCompacting dataframe: ")
+
+    total_before = total_after = 0
+    for col in evtdf.columns:
+        before = evtdf[col].memory_usage(index=False, deep=True)
+        dtype_before = str(evtdf[col].dtype)
+
+        if pd.api.types.is_integer_dtype(evtdf[col].dtype):
+            evtdf[col] = pd.to_numeric(evtdf[col], downcast='integer')
+        elif pd.api.types.is_object_dtype(evtdf[col].dtype) or pd.api.types.is_string_dtype(evtdf[col].dtype):
+            values = evtdf[col]
+            numbers = pd.to_numeric(values, errors='coerce')
+            if len(values) and numbers.notna().all() and (numbers % 1 == 0).all() and \
+                    (numbers.astype('int64').astype(str) == values.astype(str)).all():
+                # Only if the string form is kept (no leading zeros, no hex, no missing values)
+                evtdf[col] = pd.to_numeric(numbers.astype('int64'), downcast='integer')
+            elif values.nunique() <= max_cardinality * len(values):
+                evtdf[col] = values.astype('category')
+            elif strdtype:
+                evtdf[col] = values.astype(strdtype)
+
+        after = evtdf[col].memory_usage(index=False, deep=True)
+        total_before += before
+        total_after += after
+        if verbose:
+            print('- %-40s %-16s -> %-16s %10.1f MB -> %10.1f MB' % (col, dtype_before, str(evtdf[col].dtype), before / 2**20, after / 2**20))
+
+    if verbose:
+        print('- %-40s %-36s %10.1f MB -> %10.1f MB' % ('TOTAL', '', total_before / 2**20, total_after / 2**20))
+
+    return evtdf
+
+
+def evtx_files(evtxin):
+    """
+    Expand a file, directory (searched recursively) or glob pattern into the list of event log files.
+    """
+    if os.path.isdir(evtxin):
+        evtxfs = glob.glob(os.path.join(evtxin, "**", "*.evtx"), recursive=True)
+    elif glob.has_magic(evtxin):
+        evtxfs = [f for f in glob.glob(evtxin, recursive=True) if os.path.isfile(f)]
+    elif os.path.isfile(evtxin):
+        evtxfs = [evtxin]
+    else:
+        evtxfs = []
+
+    return sorted(evtxfs)
+
+
+def read_evtx_source(evtxf,batch_size=100000,cache=False,rebuild_cache=False,cache_dir=evtx_cache_dir,cache_max_size=10240,evtfilter=None,incremental=False):
+    """
+    Read one file of a batch, tagging its events with Hostname (name of the
+    folder holding the file), Channel (file name, if the events lack it) and SourceFile.
+    Runs in the worker processes of read_evtx_batch().
+    """
+    evtdf = read_evtx_all(evtxf, verbose=False, batch_size=batch_size,
+                          cache=cache, rebuild_cache=rebuild_cache, cache_dir=cache_dir, cache_max_size=cache_max_size,
+                          evtfilter=evtfilter, incremental=incremental)
+
+    evtdf.insert(0, 'Hostname', os.path.basename(os.path.dirname(os.path.abspath(evtxf))))
+    evtdf.insert(1, 'SourceFile', evtxf)
+    channel = os.path.splitext(os.path.basename(evtxf))[0]
+    if 'Channel' in evtdf.columns:
+        evtdf['Channel'] = evtdf['Channel'].fillna(channel)
+    else:
+        evtdf.insert(2, 'Channel', channel)
+
+    return evtdf
+
+
+# Fields identifying an event across copies of the same log (see evtx_dedup_hashes())
+evtx_dedup_keys = ['Computer', 'Channel', 'EventRecordID']
+# Copies of a log: Archive-* rollovers and the files of VSS (shadow copy) folders
+evtx_re_copy = re.compile(r'(?:^|[\\/])archive-[^\\/]*$|vss|shadowcopy', re.IGNORECASE)
+
+
+def evtx_dedup_hashes(evtdf):
+    """
+    Hashes (np.int64) of the Computer, Channel and EventRecordID of the events of evtdf.
+    """
+    keys = evtdf.reindex(columns=evtx_dedup_keys).astype(str)
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy().view(np.int64)
+
+
+class EvtxDedupIndex:
+    """
+    Hashes of the events kept by read_evtx_batch() with dedup, and the file each
+    one was kept from. They are kept in sorted np.int64 runs, merged as they grow
+    (like the levels of an LSM tree): about 12 bytes per event, no Python loop per event.
+
+    Parameters:
+    prio (np.ndarray): Preference of each file (lower is preferred)
+    """
+
+    def __init__(self, prio):
+        self.prio = prio
+        # [(hashes, files)], sorted by hash, the largest run first
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(hashes) for hashes, _ in self.runs)
+
+    def add(self, hashes, fileno):
+        """
+        Add the hashes (not repeated) of the events of file fileno. The events
+        already kept from a preferred file are dropped, the ones kept from a
+        less preferred file are taken over by fileno.
+
+        Returns:
+        np.ndarray: Mask of the events of fileno kept
+        dict: {file: hashes taken over from it}
+        """
+        keep = np.ones(len(hashes), dtype=bool)
+        new = np.ones(len(hashes), dtype=bool)
+        taken = {}
+        for runhashes, runfiles in self.runs:
+            pos = np.minimum(np.searchsorted(runhashes, hashes), len(runhashes) - 1)
+            found = np.flatnonzero(runhashes[pos] == hashes)
+            if not len(found):
+                continue
+            new[found] = False
+            owners = runfiles[pos[found]]
+            better = self.prio[owners] < self.prio[fileno]
+            keep[found[better]] = False
+            worse = ~better
+            for owner in np.unique(owners[worse]):
+                taken.setdefault(int(owner), []).append(hashes[found[worse][owners[worse] == owner]])
+            runfiles[pos[found[worse]]] = fileno
+
+        if new.any():
+            newhashes = np.sort(hashes[new])
+            self.runs.append((newhashes, np.full(len(newhashes), fileno, dtype=np.int32)))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            (hashes1, files1), (hashes2, files2) = self.runs[-2:]
+            allhashes = np.concatenate([hashes1, hashes2])
+            order = np.argsort(allhashes, kind='stable')
+            self.runs[-2:] = [(allhashes[order], np.concatenate([files1, files2])[order])]
+
+        return keep, {owner: np.concatenate(ownerhashes) for owner, ownerhashes in taken.items()}
+
+
+def read_evtx_batch(evtxfs,verbose=True,batch_size=100000,workers=1,cache=False,rebuild_cache=False,cache_dir=evtx_cache_dir,cache_max_size=10240,evtfilter=None,compact=False,incremental=False,dedup=False):
+    """
+    Read many event log files (e.g. several channels of hundreds of hosts) with
+    a pool of worker processes, and split the combined events per EventID like read_evtx().
+    Files are scheduled largest first so a huge log is not left for the end.
+    With dedup, events found in several files (live log, Archive-*.evtx rollovers,
+    VSS copies...) are only kept once, deduplicated as each file is read. The copy
+    kept is the one of the live log over the Archive-* and VSS files (evtx_re_copy),
+    then the one of the first file in evtxfs order, whatever order they are read in.
+    """
+    nfiles = len(evtxfs)
+    if verbose:
+        print("  + Reading %d files with %d workers" % (nfiles, workers))
+
+    # Preference of the copies of an event: live logs first, then evtxfs order
+    ranks = [1 if evtx_re_copy.search(evtxf) else 0 for evtxf in evtxfs]
+    index = EvtxDedupIndex(np.array([rank * nfiles + fileno for fileno, rank in enumerate(ranks)]))
+    evtxdfs = {}
+    ndups = {}
+    taken = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        # The live logs are read first, so their copies are seldom taken over
+        for fileno in sorted(range(nfiles), key=lambda fileno: (ranks[fileno], -os.path.getsize(evtxfs[fileno]))):
+            futures[pool.submit(read_evtx_source, evtxfs[fileno], batch_size,
+                                cache, rebuild_cache, cache_dir, cache_max_size, evtfilter, incremental)] = fileno
+        for future in tqdm(concurrent.futures.as_completed(futures), total=nfiles, disable=not verbose):
+            fileno = futures[future]
+            evtdf = future.result()
+            if dedup:
+                # Only the events kept stay in memory
+                hashes = evtx_dedup_hashes(evtdf)
+                keep = ~pd.Series(hashes).duplicated().to_numpy()
+                keep[keep], filetaken = index.add(hashes[keep], fileno)
+                for owner, ownerhashes in filetaken.items():
+                    taken.setdefault(owner, []).append(ownerhashes)
+                ndups[fileno] = len(evtdf) - int(keep.sum())
+                evtdf = evtdf[keep]
+            evtxdfs[fileno] = evtdf
+
+    # Drop the events taken over by a preferred file read later
+    for owner, ownerhashes in taken.items():
+        dups = np.isin(evtx_dedup_hashes(evtxdfs[owner]), np.concatenate(ownerhashes))
+        evtxdfs[owner] = evtxdfs[owner][~dups]
+        ndups[owner] += int(dups.sum())
+
+    if dedup and verbose:
+        nevents = len(index) + sum(ndups.values())
+        print("  + Deduplicated: %d of %d events were already in other files (%.1f%% overlap)" %
+              (sum(ndups.values()), nevents, 100.0 * sum(ndups.values()) / max(nevents, 1)))
+        for fileno, evtxf in enumerate(evtxfs):
+            if ndups[fileno]:
+                print("    - %-60s %d duplicated events" % (evtxf, ndups[fileno]))
+
+    # Keep the input order, not the completion order
+    evtalldf = pd.concat([evtxdfs[fileno] for fileno in range(nfiles)], ignore_index=True, sort=False)
+    if compact:
+        evtalldf = evtx_compact(evtalldf, verbose=verbose)
+
+    return evtx_dfs(evtalldf, verbose=verbose)
+
+
+def evtx_search_index(evtdf):
+    """
+    Build a search index of the dataframe: for each column, its distinct values
+    (as strings) and the code of the value of every row (-1 if missing).
+    Searches then only scan the distinct values, which repeat a lot in event logs.
+    """
+    index = {}
+    for col in evtdf.columns:
+        codes, uniques = pd.factorize(evtdf[col])
+        index[col] = (codes, pd.Series(list(pd.Index(uniques).astype(str)), dtype=object))
+
+    return index
+
+
+def evtx_search_index_file(cachef):
+    return cachef[:-len(".parquet")] + ".index.pkl"
+
+
+def evtx_search_index_cached(evtdf, cachef, verbose=True):
+    """
+    Load the search index kept next to the cached dataframe, building and saving it the first time.
+    evtdf must be the whole cached dataframe (not filtered): an index saved for
+    another number of rows or other columns is built again.
+    """
+    indexf = evtx_search_index_file(cachef)
+    if os.path.exists(indexf):
+        if verbose:
+            print("  + Reading search index " + indexf)
+        saved = pd.read_pickle(indexf)
+        if isinstance(saved, dict) and saved.get('rows') == len(evtdf) and saved.get('columns') == list(evtdf.columns):
+            return saved['index']
+        if verbose:
+            print("  - Search index does not match the events, building it again")
+
+    index = evtx_search_index(evtdf)
+    if os.path.exists(cachef):
+        if verbose:
+            print("  + Saving search index " + indexf)
+        pd.to_pickle({'rows': len(evtdf), 'columns': list(evtdf.columns), 'index': index}, indexf)
+
+    return index
+
+
+def evtx_string_search(evtdf, terms, index=None, regex=True, case=True):
+    """
+    Find the events containing each of the terms in any of their fields.
+
+    Parameters:
+    evtdf (pd.DataFrame): Events
+    terms (list): Strings (or regular expressions, if regex) to find
+    index (dict): evtx_search_index() of evtdf, built on the fly if not given
+
+    Returns:
+    dict: {term: pd.DataFrame with the matching events}
+    """
+    if index is None:
+        index = evtx_search_index(evtdf)
+
+    # A first pass with all the terms at once leaves few candidate values for each term
+    if regex:
+        anyterm = '|'.join('(?:' + term + ')' for term in terms)
+    else:
+        anyterm = '|'.join(re.escape(term) for term in terms)
+
+    masks = {term: np.zeros(len(evtdf), dtype=bool) for term in terms}
+    for col, (codes, uniques) in index.items():
+        candidates = uniques[uniques.str.contains(anyterm, regex=True, case=case)]
+        if candidates.empty:
+            continue
+        for term in terms:
+            # One extra (False) slot at the end, where missing values (code -1) land
+            hits = np.zeros(len(uniques) + 1, dtype=bool)
+            hits[candidates.index[candidates.str.contains(term, regex=regex, case=case)]] = True
+            masks[term] |= hits[codes]
+
+    return {term: evtdf[mask] for term, mask in masks.items()}
+
+
 # Give an enriched listing of evtid statistics
 def evtid_stats(evt):
     counts=evt['EventID'].value_counts()
@@ -151,23 +998,40 @@ def evtidssr():
     return evtidssr
 
 
+def evt_value_counts(evtcol):
+    """
+    value_counts() without the zero counts of unused categories (see evtx_compact()).
+    """
+    counts=evtcol.value_counts()
+    return counts[counts > 0]
+
+
 def evt_nonsysusers_stats(evts4624):
-    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-')]
-    print("\nWorkstationName ----------------------------------------------------")
-    print(evts4624_nonsysusers['WorkstationName'].value_counts())
-    print("\nIPAddress ----------------------------------------------------------")
-    print(evts4624_nonsysusers['IpAddress'].value_counts())
-    print("\nTargetUserName -----------------------------------------------------")
-    print(evts4624_nonsysusers['TargetUserName'].value_counts())
-    print("\nTargetUserSid ------------------------------------------------------")
-    print(evts4624_nonsysusers.groupby(["TargetUserSid", "TargetUserName"]).size())
+    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-', na=False)]
+    stats = (evt_value_counts(evts4624_nonsysusers['WorkstationName']),
+             evt_value_counts(evts4624_nonsysusers['IpAddress']),
+             evt_value_counts(evts4624_nonsysusers['TargetUserName']),
+             evts4624_nonsysusers.groupby(["TargetUserSid", "TargetUserName"], observed=True).size())
+    evt_nonsysusers_stats_print(*stats)
+    return stats
+
+
+def evt_nonsysusers_stats_print(workstations, ips, users, sids, file=None):
+    print("\nWorkstationName ----------------------------------------------------", file=file)
+    print(workstations, file=file)
+    print("\nIPAddress ----------------------------------------------------------", file=file)
+    print(ips, file=file)
+    print("\nTargetUserName -----------------------------------------------------", file=file)
+    print(users, file=file)
+    print("\nTargetUserSid ------------------------------------------------------", file=file)
+    print(sids, file=file)
 
 
 def evt_nonsysusers_access_stats(evts4624,firstdate,lastdate,freq):
-    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-')]
-    useraccess=evts4624_nonsysusers[["TimeCreated_SystemTime","WorkstationName", "IpAddress",'TargetUserName','LogonType']].set_index('TimeCreated_SystemTime')
+    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-', na=False)]
+    useraccess=evts4624_nonsysusers[["TimeCreated_SystemTime","WorkstationName", "IpAddress",'TargetUserName','LogonType']].set_index('TimeCreated_SystemTime').sort_index(kind='stable')
 
-    x=useraccess.loc[firstdate:lastdate].groupby([pd.Grouper(freq=freq), "WorkstationName", "IpAddress",'TargetUserName','LogonType']).size()
+    x=useraccess.loc[firstdate:lastdate].groupby([pd.Grouper(freq=freq), "WorkstationName", "IpAddress",'TargetUserName','LogonType'], observed=True).size()
 
     # Convert multi-Index to DF
     y=pd.DataFrame(x)
@@ -177,13 +1041,112 @@ def evt_nonsysusers_access_stats(evts4624,firstdate,lastdate,freq):
     return y
 
 
+def evt_freq_prefix_len(freq):
+    """
+    Length of the "YYYY-MM-DD HH:MM:SS" prefix of a timestamp that is enough
+    to tell apart the bins of freq (day for calendar frequencies like M or Y).
+    """
+    offset = pd.tseries.frequencies.to_offset(freq)
+    if not isinstance(offset, pd.offsets.Tick):
+        return 10
+    for prefix_len, unit in [(10, 86400), (13, 3600), (16, 60), (19, 1)]:
+        if offset.nanos % (unit * 10**9) == 0:
+            return prefix_len
+    return None
+
+
+class EvtNonsysusersStats:
+    """
+    Streaming version of evt_nonsysusers_stats() and evt_nonsysusers_access_stats().
+    4624 row dicts are counted one by one as the file is parsed (see add()), so
+    only the counters are kept in memory, never the 4624 dataframe. Access
+    counts are kept per day (or finer, for shorter freqs) and only grouped by
+    freq at the end.
+    """
+
+    def __init__(self, firstdate=None, lastdate=None, freq=None):
+        self.workstations = Counter()
+        self.ips = Counter()
+        self.users = Counter()
+        self.sids = Counter()
+        self.access = Counter()
+        for date in (firstdate, lastdate):
+            if date and evtx_filter_date(date) is None:
+                raise ValueError("Unsupported date with --stream: " + str(date) + " (use YYYY-MM-DD[ HH:MM:SS])")
+        self.window = evtx_filter(start=firstdate, end=lastdate)
+        self.freq = freq
+        self.prefix_len = evt_freq_prefix_len(freq) if freq else None
+
+    def add(self, row):
+        sid = row.get('TargetUserSid')
+        if row.get('EventID') is None or int(row['EventID']) != 4624 or sid is None or 'S-1-5-21-' not in sid:
+            return
+
+        workstation, ip, user = row.get('WorkstationName'), row.get('IpAddress'), row.get('TargetUserName')
+        if workstation is not None:
+            self.workstations[workstation] += 1
+        if ip is not None:
+            self.ips[ip] += 1
+        if user is not None:
+            self.users[user] += 1
+            self.sids[(sid, user)] += 1
+
+        if self.freq is None or None in (workstation, ip, user, row.get('LogonType')):
+            return
+        systime = (row.get('TimeCreated_SystemTime') or '').replace('T', ' ')
+        if self.window is not None and not evtx_match(None, systime, None, self.window):
+            return
+        self.access[(systime[:self.prefix_len], workstation, ip, user, int(row['LogonType']))] += 1
+
+    def stats(self):
+        """
+        Returns:
+        tuple: WorkstationName, IpAddress and TargetUserName counts, and (TargetUserSid, TargetUserName) counts
+        """
+        counts = []
+        for counter, name in [(self.workstations, 'WorkstationName'), (self.ips, 'IpAddress'), (self.users, 'TargetUserName')]:
+            count = pd.Series(counter, dtype='int64', name='count').sort_values(ascending=False, kind='stable')
+            count.index.name = name
+            counts.append(count)
+        sids = pd.Series(self.sids, dtype='int64').sort_index()
+        sids.index.names = ["TargetUserSid", "TargetUserName"]
+        counts.append(sids)
+
+        return tuple(counts)
+
+    def access_stats(self):
+        """
+        Returns:
+        pd.DataFrame: Same as evt_nonsysusers_access_stats()
+        """
+        x = pd.DataFrame([key + (count,) for key, count in self.access.items()],
+                         columns=['TimeCreated_SystemTime','WorkstationName','IpAddress','TargetUserName','LogonType','Count'])
+        # Complete the truncated timestamps, e.g. "2020-01-31" -> "2020-01-31 00:00:00"
+        x['TimeCreated_SystemTime'] = pd.to_datetime(x['TimeCreated_SystemTime'].map(lambda t: t + "0000-01-01 00:00:00"[len(t):]), utc=True)
+
+        y = x.groupby([pd.Grouper(key='TimeCreated_SystemTime', freq=self.freq), "WorkstationName", "IpAddress",'TargetUserName','LogonType'])['Count'].sum()
+        y = y.reset_index()
+        y['WorkstationName']=y['WorkstationName'].str.lower()
+        return y
+
+
+def evtx_rows(evtxf, verbose=True, evtfilter=None):
+    """
+    Row dicts of the events of an .evtx or exported .xml file, as they are parsed.
+    """
+    if os.path.splitext(evtxf)[1] == ".evtx":
+        return evtx_records_rows(evtxf, verbose=verbose, evtfilter=evtfilter)
+    return evtx_xml_rows(evtxf, verbose=verbose, evtfilter=evtfilter)
+
+
 def evt_nonsysusers_access_graph(evts4624,firstdate,lastdate,graphf):
-    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-')]
-    useraccess=evts4624_nonsysusers[["TimeCreated_SystemTime","WorkstationName", "IpAddress",'TargetUserName','LogonType']].set_index('TimeCreated_SystemTime')
+    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-', na=False)]
+    useraccess=evts4624_nonsysusers[["TimeCreated_SystemTime","WorkstationName", "IpAddress",'TargetUserName','LogonType']].set_index('TimeCreated_SystemTime').sort_index(kind='stable')
     user_access_uwil=useraccess[["WorkstationName", "IpAddress",'TargetUserName','LogonType']].loc[firstdate:lastdate].copy()
 
     user_access_uwil['WorkstationName']=user_access_uwil['WorkstationName'].str.lower()
     user_access_uwil['TargetUserName']=user_access_uwil['TargetUserName'].str.lower()
+    user_access_uwil['IpAddress']=user_access_uwil['IpAddress'].astype(str)
     user_access_uwil['LogonType']=user_access_uwil['LogonType'].astype(str)
     user_access_uwil['IP-WN-TU-LT']="["+user_access_uwil['TargetUserName']+"]["+user_access_uwil['WorkstationName']+"]["+user_access_uwil['IpAddress']+"]["+user_access_uwil['LogonType']+"]"
     user_access_uwil.drop(columns=['WorkstationName','IpAddress','TargetUserName','LogonType'],inplace=True)
@@ -219,6 +1182,142 @@ def evt_nonsysusers_access_graph(evts4624,firstdate,lastdate,graphf):
     plt.savefig(graphf)
     print("   + Plot Graph Save " + graphf)
 
+def evt_nonsysusers_access_density(evts4624,firstdate,lastdate,graphf,bins=500,max_keys=100):
+    """
+    Density version of evt_nonsysusers_access_graph() for large logs: logons
+    are counted per time bin and IP-WN-TU-LT key (bincount over integer
+    codes) and the counts are drawn as a heatmap, so the rendering time does
+    not depend on the number of events. Only the max_keys keys with more
+    logons are drawn, the rest are added up in an "[other]" row.
+
+    Returns:
+    pd.DataFrame: Logons per key (rows) and time bin (columns, bin start)
+    """
+    evts4624_nonsysusers=evts4624[evts4624['TargetUserSid'].str.contains('S-1-5-21-', na=False)]
+    useraccess=evts4624_nonsysusers[["TimeCreated_SystemTime","WorkstationName", "IpAddress",'TargetUserName','LogonType']].set_index('TimeCreated_SystemTime').sort_index()
+    user_access_uwil=useraccess.loc[firstdate:lastdate]
+
+    # Key of every logon, the labels are only built once per distinct key
+    groups = user_access_uwil.groupby(['TargetUserName','WorkstationName','IpAddress','LogonType'], observed=True)
+    group_codes = groups.ngroup()
+    labels = ["[%s][%s][%s][%s]" % (str(tu).lower(), str(wn).lower(), ip, lt) for tu, wn, ip, lt in groups.size().index]
+    key_codes, labels = pd.factorize(np.array(labels, dtype=object))
+    found = group_codes.notna().to_numpy()
+    if not found.any():
+        print("- No logons from " + firstdate + " to " + lastdate)
+        return pd.DataFrame()
+    keys = key_codes[group_codes.to_numpy()[found].astype(np.int64)]
+
+    times = user_access_uwil.index.to_numpy('datetime64[ns]')[found]
+    tmin, tmax = times.min(), times.max()
+    span = (tmax - tmin).astype(np.int64) + 1
+    tbins = np.minimum(((times - tmin).astype(np.int64) / span * bins).astype(np.int64), bins - 1)
+    counts = np.bincount(keys * bins + tbins, minlength=len(labels) * bins).reshape(len(labels), bins)
+
+    # Sorted keys, capped to the max_keys busiest ones
+    rows = np.argsort(labels, kind='stable')
+    if len(rows) > max_keys:
+        top = np.zeros(len(labels), dtype=bool)
+        top[np.argsort(-counts.sum(axis=1), kind='stable')[:max_keys]] = True
+        other = counts[~top].sum(axis=0)
+        rows = rows[top[rows]]
+        counts = np.vstack([counts[rows], other])
+        labels = list(labels[rows]) + ["[other %d keys]" % (len(labels) - max_keys)]
+    else:
+        counts = counts[rows]
+        labels = list(labels[rows])
+
+    ## Let's do some graphing
+    fig, ax0 = plt.subplots(figsize=(20, max(10, len(labels) * 0.15)))
+
+    label='IP-WN-TU-LT'
+    extent = (mdates.date2num(tmin), mdates.date2num(tmax), -0.5, len(labels) - 0.5)
+    image = ax0.imshow(np.ma.masked_equal(counts, 0), aspect='auto', origin='lower', interpolation='nearest',
+                       cmap='Reds', norm=LogNorm(vmin=0.5, vmax=max(counts.max(), 1)), extent=extent)
+    ax0.xaxis_date()
+
+    # Labels
+    ax0.set_xlabel('Date')
+    ax0.set_ylabel(label, color='g')
+    ax0.set_yticks(range(len(labels)))
+    ax0.set_yticklabels(labels)
+
+    # Same labels on the right
+    ax1 = ax0.twinx()
+    ax1.set_ylim(ax0.get_ylim())
+    ax1.set_ylabel(label, color='g')
+    ax1.set_yticks(range(len(labels)))
+    ax1.set_yticklabels(labels)
+
+    fig.colorbar(image, ax=[ax0, ax1], orientation='horizontal', label='Logons', fraction=0.03, pad=0.08, aspect=60)
+    plt.savefig(graphf)
+    plt.close(fig)
+
+    return pd.DataFrame(counts, index=labels, columns=tmin + np.arange(bins) * (span // bins))
+
+
+def evt_logon_sessions(evts, verbose=True):
+    """
+    Rebuild the logon sessions from the 4624 (logon) and 4634 / 4647 (logoff)
+    events of evts (see read_evtx()). Logons and logoffs are sorted together
+    by Computer, TargetLogonId and time, and each logon is paired with the
+    event right after it when it is a logoff: logon ids are reused (e.g.
+    after a reboot), so a logon followed by another logon of the same id has
+    no logoff. Only integer codes are sorted (and the events of a log are
+    mostly in time order already), so this scales to tens of millions of
+    events.
+
+    Returns:
+    pd.DataFrame: One row per logon, LogoffTime and Duration are NaT when
+                  the logoff was not found (session still open, log rotated...)
+    """
+    logon_cols = ['TimeCreated_SystemTime', 'Computer', 'TargetLogonId', 'TargetUserName', 'TargetDomainName', 'LogonType', 'IpAddress', 'WorkstationName']
+    logoff_cols = ['TimeCreated_SystemTime', 'Computer', 'TargetLogonId', 'EventID']
+
+    logons = evts[4624].reindex(columns=logon_cols) if 4624 in evts else pd.DataFrame(columns=logon_cols)
+    logons = logons.dropna(subset=['TimeCreated_SystemTime', 'TargetLogonId'])
+    logoffs = [evts[evtid].reindex(columns=logoff_cols) for evtid in (4634, 4647) if evtid in evts]
+    logoffs = pd.concat(logoffs, ignore_index=True) if logoffs else pd.DataFrame(columns=logoff_cols)
+    logoffs = logoffs.dropna(subset=['TimeCreated_SystemTime', 'TargetLogonId'])
+
+    # Logons first, then logoffs: kind 0 / 1
+    nlogons = len(logons)
+    computers = pd.factorize(pd.concat([logons['Computer'], logoffs['Computer']], ignore_index=True).astype(str))[0]
+    logonids = pd.factorize(pd.concat([logons['TargetLogonId'], logoffs['TargetLogonId']], ignore_index=True).astype(str))[0]
+    keys = (computers.astype(np.int64) << 32) | logonids
+    times = np.concatenate([pd.to_datetime(logons['TimeCreated_SystemTime']).to_numpy('datetime64[ns]'),
+                            pd.to_datetime(logoffs['TimeCreated_SystemTime']).to_numpy('datetime64[ns]')])
+    kinds = np.repeat(np.array([0, 1], dtype=np.int8), [nlogons, len(logoffs)])
+
+    # Sort by time (logons before logoffs of the same time), then by Computer & TargetLogonId
+    order = np.argsort(times.view(np.int64) * 2 + kinds, kind='stable')
+    order = order[np.argsort(keys[order], kind='stable')]
+    cur, nxt = order[:-1], order[1:]
+    paired = (kinds[cur] == 0) & (kinds[nxt] == 1) & (keys[cur] == keys[nxt])
+    logoff = np.full(nlogons, -1, dtype=np.int64)
+    logoff[cur[paired]] = nxt[paired] - nlogons
+    found = logoff >= 0
+
+    sessions = logons.rename(columns={'TimeCreated_SystemTime': 'LogonTime'}).reset_index(drop=True)
+    # The times were sorted as UTC datetime64, they are returned as UTC timestamps
+    sessions['LogonTime'] = pd.to_datetime(times[:nlogons], utc=True)
+    logofftimes = np.full(nlogons, np.datetime64('NaT'), dtype='datetime64[ns]')
+    logofftimes[found] = times[nlogons:][logoff[found]]
+    sessions['LogoffTime'] = pd.to_datetime(logofftimes, utc=True)
+    sessions['Duration'] = sessions['LogoffTime'] - sessions['LogonTime']
+    logoffevtids = np.zeros(nlogons, dtype=np.int64)
+    logoffevtids[found] = logoffs['EventID'].to_numpy()[logoff[found]]
+    sessions['LogoffEventID'] = pd.Series(logoffevtids, dtype='Int64').mask(~found)
+    sessions = sessions[['LogonTime', 'LogoffTime', 'Duration', 'Computer', 'TargetUserName', 'TargetDomainName', 'TargetLogonId',
+                         'LogonType', 'IpAddress', 'WorkstationName', 'LogoffEventID']]
+    sessions = sessions.sort_values('LogonTime', kind='stable', ignore_index=True)
+
+    if verbose == True:
+        print("- %d sessions, %d without logoff" % (len(sessions), (~found).sum()))
+
+    return sessions
+
+
 evtids={
 1100:'The event logging service has shut down',
 1101:'Audit events have been dropped by the transport.',
@@ -644,6 +1743,223 @@ evtids={
 8191:'Highest System-Defined Audit Message Value',
 }
 
+# EventIDs read by each analysis (None: all of them), so the parser can skip the rest
+evtx_analyses_evtids = {
+    'id_stats': None,
+    'string_search': None,
+    'string_search_file': None,
+    'nonsysusers': [4624],
+    'nonsysusers_access': [4624],
+    'nonsysusers_graph': [4624],
+    'logon_sessions': [4624, 4634, 4647],
+}
+
+# Number of arguments of each analysis (as in the command line options)
+evtx_analyses_nargs = {
+    'id_stats': 1,
+    'string_search': 1,
+    'string_search_file': 1,
+    'nonsysusers': 0,
+    'nonsysusers_access': 3,
+    'nonsysusers_graph': 3,
+    'logon_sessions': 0,
+}
+
+
+def evtx_plan_file(planf):
+    """
+    Read the analyses of a plan file: a JSON (or YAML, if PyYAML is
+    installed) list of {"analysis": name, "args": [...]} entries, e.g.
+    [{"analysis": "id_stats", "args": ["all"]}, {"analysis": "nonsysusers"}]
+
+    Returns:
+    list: (analysis name, [arguments]) tuples
+    """
+    with open(planf) as f:
+        if os.path.splitext(planf)[1].lower() in ('.yml', '.yaml'):
+            import yaml
+            entries = yaml.safe_load(f)
+        else:
+            entries = json.load(f)
+
+    plan = []
+    for entry in entries:
+        name = entry.get('analysis')
+        params = [str(value) for value in entry.get('args', [])]
+        if name not in evtx_analyses_nargs:
+            raise ValueError("%s: unknown analysis %s" % (planf, name))
+        if len(params) != evtx_analyses_nargs[name]:
+            raise ValueError("%s: %s takes %d arguments" % (planf, name, evtx_analyses_nargs[name]))
+        plan.append((name, params))
+
+    return plan
+
+
+def evtx_plan(args):
+    """
+    Analyses requested in args: every (possibly repeated) analysis option,
+    then the ones of the --plan file.
+
+    Returns:
+    list: (analysis name, [arguments]) tuples
+    """
+    plan = []
+    for name in evtx_analyses_nargs:
+        values = getattr(args, name)
+        if not values:
+            continue
+        if evtx_analyses_nargs[name] == 0:
+            plan.append((name, []))
+        elif evtx_analyses_nargs[name] == 1:
+            plan += [(name, [value]) for value in values]
+        else:
+            plan += [(name, list(value)) for value in values]
+    if args.plan:
+        plan += evtx_plan_file(args.plan)
+
+    return plan
+
+
+def evtx_analysis_filter(plan, channels=None):
+    """
+    Record filter covering what the analyses of the plan need: the union of
+    their EventIDs and time windows, and the channels (--channel option).
+    """
+    evtids = set()
+    windows = []
+    for name, params in plan:
+        if name == 'id_stats':
+            thisevtids = None if params[0].lower() == "all" else [int(params[0])]
+        else:
+            thisevtids = evtx_analyses_evtids[name]
+        if thisevtids is None or evtids is None:
+            evtids = None
+        else:
+            evtids.update(thisevtids)
+        windows.append(params[:2] if name in ('nonsysusers_access', 'nonsysusers_graph') else None)
+
+    firstdate = lastdate = None
+    if windows and None not in windows:
+        windows = [[evtx_filter_date(date) for date in window] for window in windows]
+    if windows and None not in windows and None not in itertools.chain(*windows):
+        firstdate = min(window[0] for window in windows)
+        # Partial end dates are inclusive: "2020-01" ends after "2020-01-31"
+        lastdate = max((window[1] for window in windows), key=lambda end: end + "~")
+
+    return evtx_filter(evtids=evtids, start=firstdate, end=lastdate, channels=channels)
+
+
+def evtx_analysis_run(evts, name, params, args, evtfilter=None):
+    """
+    Run one analysis of the plan on the events dataframes (see read_evtx()),
+    read with the record filter evtfilter.
+    Returns its result, see evtx_analysis_output() (None if the events it
+    needs are not in the file, or in the requested window).
+    """
+    if name == 'id_stats':
+        evtid = params[0] if params[0].lower() == "all" else int(params[0])
+    else:
+        evtid = 4624 if name in ('nonsysusers', 'nonsysusers_access', 'nonsysusers_graph') else "all"
+    if evtid not in evts:
+        print("\n- No events with EventID " + str(evtid) + " for analysis " + name)
+        return None
+
+    if name == 'id_stats': #string value to calculate stat - all,1100...
+        print("\n+ Executing plugin analysis id_stats\n")
+        value = params[0]
+        if value.lower() == "all":            
+            evtsall=evts[value]
+        else:            
+            evtsall=evts[int(value)]
+        return evtid_stats(evtsall)
+    elif name in ('string_search', 'string_search_file'): #string | file of strings
+        print("\n+ Executing plugin analysis String Search\n")
+        evtsall=evts['all']       
+        index = None
+        # The index is kept for the whole cached parse only, not for filtered or incremental reads
+        if (args.search_index and not args.no_cache and os.path.isfile(args.evtxf)
+                and evtfilter is None and not getattr(args, 'incremental', False)):
+            index = evtx_search_index_cached(evtsall, evtx_cache_file(args.evtxf, args.cache_dir))
+        if name == 'string_search':
+            return evtx_string_search(evtsall, params, index=index)[params[0]]
+        with open(params[0]) as f:
+            terms = [line.strip() for line in f if line.strip()]
+        return evtx_string_search(evtsall, terms, index=index, regex=False)
+    elif name == 'nonsysusers':
+        print("\n+ Executing plugin analysis nonsysusers stats\n")
+        evts4624=evts[4624]
+        return (evt_nonsysusers_stats(evts4624),)
+    elif name == 'nonsysusers_access': # firstdate,lastdate,freq        
+        firstdate, lastdate, freq = params
+        print("\n+ Executing plugin analysis nonsysusers access stats from " + firstdate + " to "  + lastdate + " freq. " + freq + "\n")
+        evts4624=evts[4624]
+        return evt_nonsysusers_access_stats(evts4624,firstdate,lastdate,freq)
+    elif name == 'nonsysusers_graph': # firstdate,lastdate,graph_filename        
+        firstdate, lastdate, graphf = params
+        print("\n+ Executing plugin analysis nonsysusers access graph stats from " + firstdate + " to "  + lastdate + " save graph to " + graphf + "\n")
+        evts4624=evts[4624]        
+        if args.graph_density:
+            return evt_nonsysusers_access_density(evts4624,firstdate,lastdate,graphf,bins=args.graph_bins,max_keys=args.graph_max_keys)
+        return evt_nonsysusers_access_graph(evts4624,firstdate,lastdate,graphf)
+    elif name == 'logon_sessions':
+        print("\n+ Executing plugin analysis logon sessions\n")
+        return evt_logon_sessions(evts)
+
+
+def evtx_analysis_stream(evtxfs, plan, evtfilter):
+    """
+    Run the nonsysusers / nonsysusers_access analyses of the plan while
+    the files are parsed (see EvtNonsysusersStats), all in the same pass.
+    Returns their results, in plan order.
+    """
+    aggregators = [EvtNonsysusersStats(*params) for name, params in plan]
+    for thisevtxf in evtxfs:
+        for row in evtx_rows(thisevtxf, evtfilter=evtfilter):
+            for aggregator in aggregators:
+                aggregator.add(row)
+
+    results = []
+    for (name, params), aggregator in zip(plan, aggregators):
+        if name == 'nonsysusers':
+            print("\n+ Executing plugin analysis nonsysusers stats\n")
+            stats = aggregator.stats()
+            evt_nonsysusers_stats_print(*stats)
+            results.append((stats,))
+        else:
+            firstdate, lastdate, freq = params
+            print("\n+ Executing plugin analysis nonsysusers access stats from " + firstdate + " to "  + lastdate + " freq. " + freq + "\n")
+            results.append(aggregator.access_stats())
+
+    return results
+
+
+def evtx_analysis_output(name, result, outf=None):
+    """
+    Print the result of an analysis and, with outf, save it too: tables as
+    CSV, the nonsysusers stats as text.
+    """
+    if isinstance(result, tuple): # nonsysusers stats, already printed
+        if outf:
+            with open(outf + ".txt", "w") as f:
+                evt_nonsysusers_stats_print(*result[0], file=f)
+        return
+    if isinstance(result, dict): # string_search_file: {term: matches}
+        for term, searchval in result.items():
+            print("\n- %s [%d]" % (term, len(searchval)))
+            if not searchval.empty:
+                print(searchval)
+        if outf:
+            pd.concat(result, names=['Term']).to_csv(outf + ".csv")
+        return
+
+    if result is None:
+        return
+    if name != 'nonsysusers_graph':
+        print(result)
+    if outf and result is not None:
+        result.to_csv(outf + ".csv")
+
+
 def main():
     
     pd.set_option('display.max_columns', None)  
@@ -651,12 +1967,31 @@ def main():
     pd.set_option('max_colwidth', None)
     
     parser = argparse.ArgumentParser(prog="ds4n6-analysis_evtx.py")    
-    parser.add_argument('--id_stats', metavar="evtid", action="store", type=str, help="EVT id stats <eventid>")
-    parser.add_argument('--string_search', metavar="string", action="store", type=str, help="String Search <string to find>")
+    parser.add_argument('--id_stats', metavar="evtid", action="append", type=str, help="EVT id stats <eventid>")
+    parser.add_argument('--string_search', metavar="string", action="append", type=str, help="String Search <string to find>")
+    parser.add_argument('--string_search_file', metavar="file", action="append", type=str, help="String Search <file with one string to find per line>")
+    parser.add_argument('--search_index', action="store_true", help="Keep a search index next to the cached file for faster repeated searches")
     parser.add_argument('--nonsysusers', action="store_true", help="nonsysusers stats")
-    parser.add_argument('--nonsysusers_access', action="store", type=str, nargs=3, help="Nonsysusers access stats <start date><end date><freq:Y|M...>")
-    parser.add_argument('--nonsysusers_graph', action="store", type=str, nargs=3, help="Nonsysusers graph <start date><end date><graph filename output>")
-    parser.add_argument('evtxf', metavar="evtx_file", type=str, help=".evtx path")
+    parser.add_argument('--nonsysusers_access', action="append", type=str, nargs=3, help="Nonsysusers access stats <start date><end date><freq:Y|M...>")
+    parser.add_argument('--nonsysusers_graph', action="append", type=str, nargs=3, help="Nonsysusers graph <start date><end date><graph filename output>")
+    parser.add_argument('--graph_density', action="store_true", help="Draw --nonsysusers_graph as a heatmap of logons per time bin and key (for large logs)")
+    parser.add_argument('--graph_bins', metavar="N", action="store", type=int, default=500, help="Time bins of --graph_density (default: 500)")
+    parser.add_argument('--graph_max_keys', metavar="N", action="store", type=int, default=100, help="IP-WN-TU-LT keys drawn by --graph_density, the rest are added up (default: 100)")
+    parser.add_argument('--logon_sessions', action="store_true", help="Logon sessions (4624 logons paired with their 4634/4647 logoffs)")
+    parser.add_argument('--plan', metavar="file", action="store", type=str, help="JSON (or YAML) list of analyses to run, see evtx_plan_file()")
+    parser.add_argument('--output_dir', metavar="dir", action="store", type=str, help="Also save the result of every analysis to its own file in this directory")
+    parser.add_argument('--stream', action="store_true", help="Compute --nonsysusers / --nonsysusers_access while parsing, without building the events dataframes (no other analysis allowed)")
+    parser.add_argument('--channel', metavar="channel", action="store", type=str, nargs="+", help="Only read events of these channels (e.g. Security)")
+    parser.add_argument('--dedup', action="store_true", help="Batch mode: keep only once the events found in several files (rollovers, VSS copies...)")
+    parser.add_argument('--incremental', action="store_true", help="Only parse the records added to the .evtx file since the last --incremental run")
+    parser.add_argument('--compact', action="store_true", help="Shrink the parsed events in memory (categoricals, downcast integers, Arrow strings)")
+    parser.add_argument('--batch_size', metavar="rows", action="store", type=int, default=100000, help="Rows converted to columns at a time while parsing (default: 100000)")
+    parser.add_argument('--workers', metavar="N", action="store", type=int, default=1, help="Parse the .evtx file (or the files of a directory/glob) with N worker processes (default: 1)")
+    parser.add_argument('--no_cache', '--no-cache', action="store_true", help="Do not read or write the parsed files cache")
+    parser.add_argument('--rebuild_cache', '--rebuild-cache', action="store_true", help="Parse the file again and replace its cache entry")
+    parser.add_argument('--cache_dir', metavar="dir", action="store", type=str, default=evtx_cache_dir, help="Parsed files cache directory (default: " + evtx_cache_dir + ")")
+    parser.add_argument('--cache_max_size', metavar="MB", action="store", type=int, default=10240, help="Maximum size of the parsed files cache (default: 10240)")
+    parser.add_argument('evtxf', metavar="evtx_file", type=str, help=".evtx path, or directory / glob pattern of .evtx files (batch mode)")
 
     args = parser.parse_args()    
     evtxf = args.evtxf
@@ -664,43 +1999,48 @@ def main():
     print("DS4N6 (evtx) Events Analysis v1.0\n")
 
     print("+ Extract " + evtxf)
-    if not os.path.exists(evtxf):
+    evtxfs = evtx_files(evtxf)
+    if not evtxfs:
         print('The file specified does not exist')
         sys.exit()
     
-    evts = read_evtx(evtxf)    
+    plan = evtx_plan(args)
+    if not plan:
+        print("Argument no found!")    
+        return
 
-    if args.id_stats: #string value to calculate stat - all,1100...
-        print("\n+ Executing plugin analysis id_stats\n")
-        value = args.id_stats
-        if value.lower() == "all":            
-            evtsall=evts[value]
-        else:            
-            evtsall=evts[int(value)]
-        stats = evtid_stats(evtsall)
-        print(stats)
-    elif args.string_search: #string
-        print("\n+ Executing plugin analysis String Search\n")
-        evtsall=evts['all']       
-        searchval=evtsall[evtsall.apply(lambda row: row.astype(str).str.contains(args.string_search).any(), axis=1)]
-        print(searchval)
-    elif args.nonsysusers:
-        print("\n+ Executing plugin analysis nonsysusers stats\n")
-        evts4624=evts[4624]
-        nonusers = evt_nonsysusers_stats(evts4624)
-        nonusers
-    elif args.nonsysusers_access: # firstdate,lastdate,freq        
-        firstdate, lastdate, freq = args.nonsysusers_access
-        print("\n+ Executing plugin analysis nonsysusers access stats from " + firstdate + " to "  + lastdate + " freq. " + freq + "\n")
-        evts4624=evts[4624]
-        nonusers = evt_nonsysusers_access_stats(evts4624,firstdate,lastdate,freq)
-    elif args.nonsysusers_graph: # firstdate,lastdate,graph_filename        
-        firstdate, lastdate, graphf = args.nonsysusers_graph
-        print("\n+ Executing plugin analysis nonsysusers access graph stats from " + firstdate + " to "  + lastdate + " save graph to " + graphf + "\n")
-        evts4624=evts[4624]        
-        nonusers = evt_nonsysusers_access_graph(evts4624,firstdate,lastdate,graphf)
+    streamed = ('nonsysusers', 'nonsysusers_access')
+    if args.stream and any(name not in streamed for name, params in plan):
+        parser.error("--stream only computes --nonsysusers / --nonsysusers_access, not: " +
+                     ", ".join(sorted(set(name for name, params in plan if name not in streamed))))
+
+    # Every analysis of the plan is run on the same parse
+    evtfilter = evtx_analysis_filter(plan, channels=args.channel)
+    if args.stream:
+        results = evtx_analysis_stream(evtxfs, plan, evtfilter)
     else:
-        print("Argument no found!")    
+        if os.path.isfile(evtxf):
+            evts = read_evtx(evtxf, batch_size=args.batch_size, workers=args.workers,
+                             cache=not args.no_cache, rebuild_cache=args.rebuild_cache,
+                             cache_dir=args.cache_dir, cache_max_size=args.cache_max_size,
+                             evtfilter=evtfilter, compact=args.compact, incremental=args.incremental)
+        else:
+            evts = read_evtx_batch(evtxfs, batch_size=args.batch_size, workers=args.workers,
+                                   cache=not args.no_cache, rebuild_cache=args.rebuild_cache,
+                                   cache_dir=args.cache_dir, cache_max_size=args.cache_max_size,
+                                   evtfilter=evtfilter, compact=args.compact, incremental=args.incremental,
+                                   dedup=args.dedup)
+        results = None
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    for n, (name, params) in enumerate(plan):
+        if results is None:
+            result = evtx_analysis_run(evts, name, params, args, evtfilter)
+        else:
+            result = results[n]
+        outf = os.path.join(args.output_dir, "%02d_%s" % (n + 1, name)) if args.output_dir else None
+        evtx_analysis_output(name, result, outf)
 
 
 if __name__ == "__main__":
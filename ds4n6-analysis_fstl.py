@@ -10,9 +10,18 @@ __email__ = "ds4n6@one-esecurity.com"
 """
 
 import argparse
+import csv
 import os
 import time
-
+import json
+import glob
+import shutil
+import operator
+import urllib.parse
+import contextlib
+import concurrent.futures
+
+import numpy  as np
 import pandas as pd
 
 
@@ -29,21 +38,212 @@ def fstl_size_top_n(fstl, n):
     return fstl[~fstl['FileName'].str.contains("\(\$FILE_NAME\)")][['Size','FileName']].sort_values(by='Size', ascending=False).drop_duplicates().head(n)
 
 
+def fstl_size_top_n_merge(top, chunk, n):
+    """ Add a chunk of (Size, FileName) files to the top n files found so far """
+    chunk = chunk[~chunk['FileName'].str.contains("($FILE_NAME)", regex=False, na=False)]
+    top = pd.concat([top, chunk.drop_duplicates().nlargest(n, 'Size')])
+    return top.drop_duplicates().nlargest(n, 'Size')
+
+
+def fstl_size_top_n_stream(fstlf, n, chunksize=1000000):
+    """ Get top n max size files of a FSTL file, like fstl_size_top_n(), reading it in one
+    sequential pass of chunksize lines. Only the Size and File Name columns are parsed, and
+    only the n largest files found so far are kept, so memory does not depend on the file size
+
+    Parameters:
+    fstlf (str): FSTL file
+    n (int): Number of desired results
+    chunksize (int): Lines read at a time
+
+    Returns:
+    pd.DataFrame: Size, FileName
+    """
+    top = pd.DataFrame({'Size': pd.Series(dtype='int64'), 'FileName': pd.Series(dtype=object)})
+    for chunk in pd.read_csv(fstlf, usecols=['Size', 'File Name'], chunksize=chunksize):
+        chunk = chunk.rename(columns={"File Name": "FileName"})[['Size', 'FileName']]
+        top = fstl_size_top_n_merge(top, chunk, n)
+    return top
+
+
 def cmd_fstl_size_top_n(args):
-    fstl = read_fstl(args.fstl_file, windows=args.windows)
-    results = fstl_size_top_n(fstl,args.n)
+    if args.dataset:
+        results = fstl_size_top_n_dataset(args.fstl_file, args.n)
+    elif args.stream:
+        results = fstl_size_top_n_stream(args.fstl_file, args.n, chunksize=args.chunksize)
+    else:
+        fstl = read_fstl(args.fstl_file, windows=args.windows)
+        results = fstl_size_top_n(fstl,args.n)
     print(results)
 
-def read_fstls_filetypes(fstld, hosts, file_types, verbose=False):
-    fstl_names = ['1', 'path', 'inode', 'perms', 'user', 'group', 'fsize', 'mtime', 'atime', 'ctime', 'btime']
-    fstl_hostname_names = ['host-vol', '1', 'path', 'inode', 'perms', 'user', 'group', 'fsize', 'mtime', 'atime', 'ctime', 'btime']
-    fstl_hostname_names_short = ['host-vol', 'path', 'inode', 'fsize', 'mtime', 'atime', 'ctime', 'btime']
+# Body format (TSK 3.x): MD5|name|inode|mode_as_string|UID|GID|size|atime|mtime|ctime|crtime
+fstl_names = ['1', 'path', 'inode', 'perms', 'user', 'group', 'fsize', 'atime', 'mtime', 'ctime', 'btime']
+fstl_hostname_names_short = ['host-vol', 'path', 'inode', 'fsize', 'mtime', 'atime', 'ctime', 'btime']
+# Columns of the files read per file type, path-hash right after the path
+fstl_hostname_names_hash = fstl_hostname_names_short[:2] + ['path-hash'] + fstl_hostname_names_short[2:]
+fstl_tstamp_types = {'mtime': 'datetime64[s]', 'atime': 'datetime64[s]', 'ctime': 'datetime64[s]', 'btime': 'datetime64[s]'}
+# inode is a string: NTFS inodes are <MFT entry>-<type>-<id> (eg: 62469-128-6)
+fstl_body_dtypes = {'path': 'str', 'inode': 'str', 'fsize': 'int64', 'mtime': 'int64', 'atime': 'int64', 'ctime': 'int64', 'btime': 'int64'}
+
+
+def read_bodyfile(filename, engine='c'):
+    """ Read a bodyfile, parsing only the columns used by the analyses, with their dtypes
+    declared up front. The 4 timestamps (epoch secs) are converted in one operation.
+
+    Parameters:
+    filename (str): Bodyfile
+    engine (str): 'c' (pandas) or 'pyarrow' (Arrow CSV reader, multithreaded, needs pyarrow)
+
+    Returns:
+    pd.DataFrame: path, inode, fsize, mtime, atime, ctime, btime
+    """
+    columns = fstl_hostname_names_short[1:]
+    if engine == 'pyarrow':
+        import pyarrow
+        import pyarrow.csv
+        table = pyarrow.csv.read_csv(filename,
+            read_options=pyarrow.csv.ReadOptions(column_names=fstl_names),
+            parse_options=pyarrow.csv.ParseOptions(delimiter='|', quote_char=False),
+            convert_options=pyarrow.csv.ConvertOptions(include_columns=columns,
+                column_types={column: pyarrow.string() if dtype == 'str' else pyarrow.int64() for column, dtype in fstl_body_dtypes.items()}))
+        fstlraw = table.to_pandas()
+    else:
+        # Paths can have quotes, they are not quoted fields
+        fstlraw = pd.read_csv(filename, sep='|', names=fstl_names, usecols=columns, dtype=fstl_body_dtypes, quoting=csv.QUOTE_NONE)[columns]
+    tstamps = list(fstl_tstamp_types)
+    fstlraw[tstamps] = fstlraw[tstamps].to_numpy().view('datetime64[s]')
+    return fstlraw
+
 
-    # Initialize dictionary of dfs
-    dfs = {}
-    for file_type in file_types:
-        dfs[file_type] = pd.DataFrame(columns = fstl_hostname_names_short)
+def fstl_path_hash(paths):
+    """ Stable 64-bit hash of the lowercase paths. Unlike hash(), it does not depend on
+    PYTHONHASHSEED, so it is the same in every process, run and machine.
+
+    Parameters:
+    paths (pd.Series): Paths
+
+    Returns:
+    np.ndarray: int64 hashes
+    """
+    # Paths are mostly unique, factorizing them first (categorize) only costs time
+    return pd.util.hash_array(paths.str.lower().to_numpy(dtype=object), categorize=False).view('int64')
+
+
+def fstl_path_exts(paths):
+    """ Lowercase extension of the paths (NaN if they have none) """
+    return paths.str.extract(r'\.([^./\\]+)$', expand=False).str.lower()
+
+
+def read_fstl_host_filetypes(fstld, host, file_types, engine='c'):
+    """ Read the bodyfile of a host, keeping only the files of each file type
+    (extension, case insensitive).
+    Runs in the worker processes of read_fstls_filetypes()
 
+    Returns:
+    tuple: No. lines of the bodyfile, {file_type: pd.DataFrame}
+    """
+    filename = fstld + "/" + host + "/fstlmaster.body.raw"
+    dirname = os.path.dirname(filename)
+    dirnamebase = os.path.basename(dirname)
+    fstlraw = read_bodyfile(filename, engine=engine)
+    fstlraw.insert(0,'host-vol',dirnamebase)
+
+    # Lowercase extension of every path in one pass, then one group per file type
+    exts = fstl_path_exts(fstlraw['path'])
+    wanted = exts.isin([file_type.lower() for file_type in file_types]).to_numpy()
+    extrows = fstlraw.index[wanted].groupby(exts[wanted].to_numpy())
+
+    thisdfs={}
+    for file_type in file_types:
+        thisdfs[file_type] = fstlraw.loc[extrows.get(file_type.lower(), [])]
+        thisdfs[file_type].insert(2, 'path-hash', fstl_path_hash(thisdfs[file_type]['path']))
+
+    return fstlraw.path.size, thisdfs
+
+
+def fstl_dataset_partitioning():
+    """ Partitioning of the FSTL datasets: <dataset>/host-vol=<host>/ext=<extension>/ """
+    import pyarrow
+    import pyarrow.dataset
+    return pyarrow.dataset.partitioning(pyarrow.schema([('host-vol', pyarrow.string()), ('ext', pyarrow.string())]), flavor='hive')
+
+
+def fstl_dataset(datasetd):
+    """ Parquet dataset written by read_fstls_filetypes(dataset=datasetd) """
+    import pyarrow.dataset
+    return pyarrow.dataset.dataset(datasetd, format='parquet', partitioning=fstl_dataset_partitioning())
+
+
+def fstl_dataset_filter(file_types):
+    """ Dataset filter on the ext partitions of the file types (None: all the files) """
+    import pyarrow.dataset
+    if file_types is None:
+        return None
+    return pyarrow.dataset.field('ext').isin([file_type.lower() for file_type in file_types])
+
+
+def write_fstl_host_dataset(fstld, host, file_types, datasetd, engine='c'):
+    """ Read the bodyfile of a host and write its files of each file type (all of them
+    if file_types is None) to the partitions of the host in the dataset datasetd.
+    Runs in the worker processes of read_fstls_filetypes()
+
+    Returns:
+    tuple: No. lines of the bodyfile, {file_type: No. files written}
+    """
+    import pyarrow
+    import pyarrow.dataset
+    filename = fstld + "/" + host + "/fstlmaster.body.raw"
+    fstlraw = read_bodyfile(filename, engine=engine)
+    nlines = fstlraw.path.size
+    fstlraw.insert(0, 'host-vol', os.path.basename(os.path.dirname(filename)))
+    fstlraw['ext'] = fstl_path_exts(fstlraw['path'])
+    if file_types is not None:
+        fstlraw = fstlraw[fstlraw['ext'].isin([file_type.lower() for file_type in file_types])]
+    fstlraw['path-hash'] = fstl_path_hash(fstlraw['path'])
+
+    # The host is written again from scratch. Partition values are URI encoded in the
+    # directory names (host%201), so they are decoded to find the ones of the host
+    if os.path.isdir(datasetd):
+        for hostd in os.listdir(datasetd):
+            if hostd.startswith('host-vol=') and urllib.parse.unquote(hostd[len('host-vol='):]) == host:
+                shutil.rmtree(os.path.join(datasetd, hostd), ignore_errors=True)
+    pyarrow.dataset.write_dataset(pyarrow.Table.from_pandas(fstlraw, preserve_index=False), datasetd, format='parquet',
+                                  partitioning=fstl_dataset_partitioning(), existing_data_behavior='delete_matching')
+    if file_types is None:
+        return nlines, {'all': len(fstlraw)}
+    counts = fstlraw['ext'].value_counts()
+    return nlines, {file_type: int(counts.get(file_type.lower(), 0)) for file_type in file_types}
+
+
+@contextlib.contextmanager
+def fstl_pool(workers):
+    """ Pool of worker processes (None with workers <= 1), shut down when the block ends.
+    If the block fails (e.g. a bodyfile could not be read), the tasks not started are
+    cancelled, so the error is raised without reading the remaining hosts.
+    """
+    if workers <= 1:
+        yield None
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            yield pool
+        except BaseException:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def read_fstls_filetypes(fstld, hosts, file_types, verbose=False, workers=1, engine='c', dataset=None):
+    """ Read the bodyfiles (<fstld>/<host>/fstlmaster.body.raw) of the hosts, keeping
+    only the files of each file type. With workers > 1 the hosts are read by a pool
+    of worker processes. engine is the CSV reader of read_bodyfile() ('c' or 'pyarrow').
+
+    With dataset, the files are not kept in memory: each host is written to the Parquet
+    dataset directory dataset, partitioned by host and extension (file_types can then
+    be None, to write all the files), for unique_files_folder_analysis_dataset() and
+    fstl_size_top_n_dataset().
+
+    Returns:
+    dict: {file_type: pd.DataFrame} (dataset: the dataset directory)
+    """
     nhosts = len(hosts)
 
     if verbose:
@@ -52,60 +252,50 @@ def read_fstls_filetypes(fstld, hosts, file_types, verbose=False):
 
     start_time = time.time()
 
-    cnt = 1
-    for host in hosts:
-        fstlf = fstld + "/" + host + "/fstlmaster.body.raw"
-        os.system("ls -l " + fstlf + " | sed 's:" + fstld + "/::' | awk '{ print \"      \" $0 }'")
-
-        filename=fstlf
-        if verbose:
-            print("  + [" + str(cnt) + "/" + str(nhosts) + "] Reading file: " + filename)
-        dirname = os.path.dirname(filename)
-        dirnamebase = os.path.basename(dirname)
-        parse_dates = ['mtime', 'atime','ctime']
-        fstlraw = pd.read_csv(filename, sep='|', names=fstl_names, parse_dates=parse_dates, date_parser=lambda col: pd.to_datetime(col, unit="s"))
-        fstlraw.insert(0,'host-vol',dirnamebase)
-
-        # Remove meaningless cols -------------------------------
-        # Delete first col
-        del fstlraw['1']
-        # Delete Meaningless Windows cols
-        del fstlraw['perms']
-        del fstlraw['user']
-        del fstlraw['group']
-        # Add path-hash col
-        fstlraw.insert(2,'path-hash',0)
-        fstlraw['path-hash'] = fstlraw['path'].str.lower().apply(hash)
-
-        thisdfs={}
-        for file_type in file_types:
-            thisdfs[file_type] = fstlraw[fstlraw['path'].str.contains("."+file_type+"$")]
-            dfs[file_type] = pd.concat([dfs[file_type], thisdfs[file_type]])
-
-        if verbose:
-            print("    - No.lines fstls:   " + str(fstlraw.path.size))
-            for file_type in file_types:
-                print("    - No.lines " + file_type + ":     " + str(thisdfs[file_type].path.size))
-                print("    - No.lines " + file_type + " acc: " + str(dfs[file_type].path.size))
+    hostdfs = {}
+    if dataset is not None:
+        os.makedirs(dataset, exist_ok=True)
+        readhost, args = write_fstl_host_dataset, (file_types, dataset, engine)
+    else:
+        readhost, args = read_fstl_host_filetypes, (file_types, engine)
+    with fstl_pool(workers) as pool:
+        if pool is not None:
+            futures = {pool.submit(readhost, fstld, host, *args): host for host in hosts}
+            results = ((futures[future], future.result()) for future in concurrent.futures.as_completed(futures))
         else:
+            results = ((host, readhost(fstld, host, *args)) for host in hosts)
+
+        cnt = 1
+        for host, (nlines, thisdfs) in results:
+            hostdfs[host] = thisdfs
             if verbose:
-                print(".", end='')
-            if ( cnt % 10 == 0 ):
-                print("[" + str(cnt) + "]", end='')
-        cnt = cnt + 1
+                filename = fstld + "/" + host + "/fstlmaster.body.raw"
+                print("  + [" + str(cnt) + "/" + str(nhosts) + "] Read file: " + filename + " (" + str(os.path.getsize(filename)) + " bytes)")
+                print("    - No.lines fstls:   " + str(nlines))
+                for file_type, thisdf in thisdfs.items():
+                    print("    - No.lines " + file_type + ":     " + str(thisdf if dataset is not None else thisdf.path.size))
+            elif ( cnt % 10 == 0 ):
+                print("[" + str(cnt) + "]", end='', flush=True)
+            cnt = cnt + 1
+    if not verbose and nhosts >= 10:
+        print()
 
     if verbose:
         print("- "+str(nhosts)+" files read")
-        print("- Creating Low-Res TStamp versions of DFs")
 
+    if dataset is not None:
+        if verbose:
+            print("- Dataset: " + dataset)
+            print("- Elapsed time: "+str(time.time() - start_time))
+        return dataset
+
+    # Merge the hosts once, in the hosts order
+    dfs = {}
     for file_type in file_types:
-        dfs[file_type]=dfs[file_type].astype(
-            {
-                'path-hash': 'int64', 
-                'mtime': 'datetime64[s]', 
-                'atime': 'datetime64[s]', 
-                'ctime': 'datetime64[s]', 
-                'btime': 'datetime64[s]'})
+        parts = [hostdfs[host][file_type] for host in hosts]
+        dfs[file_type] = pd.concat(parts) if parts else pd.DataFrame(columns = fstl_hostname_names_hash).astype(fstl_tstamp_types).astype({'path-hash': 'int64'})
+        if verbose:
+            print("    - No.lines " + file_type + " acc: " + str(dfs[file_type].path.size))
 
     elapsed_time = time.time() - start_time
     if verbose:
@@ -113,42 +303,79 @@ def read_fstls_filetypes(fstld, hosts, file_types, verbose=False):
 
     return dfs
 
-def unique_files_folder_analysis(exefs, thisexed_path, exef_intg_max_occs, compop='==', recurse=False, prevdays=0, tsfield='m', verbose=False):
-    # TODO:
-    # - Include "recurse" option so the sub-folders can be included or excluded
-
-    if compop not in ['>', '<', '>=', '==', '<=']:
+fstl_compops = {'>': operator.gt, '<': operator.lt, '>=': operator.ge, '==': operator.eq, '<=': operator.le}
+
+
+class FstlFolderIndex:
+    """ Index of the files of a dataframe by their (lowercase) parent folder, so the files
+    of a folder are found by looking at the folders only, not at every path.
+    Build it once and pass it to unique_files_folder_analysis() to query many folders.
+
+    Parameters:
+    fstldf (pd.DataFrame): Files, as read by read_fstls_filetypes()
+    """
+
+    def __init__(self, fstldf):
+        parents = fstldf['path'].fillna('').astype(str).str.lower().str.rpartition('/')
+        # Folder of each file, with its trailing "/" ("" for paths with no folder)
+        codes, folders = pd.factorize(parents[0] + parents[1]) if len(parents.columns) else (np.empty(0, dtype=np.intp), [])
+        self.folders = pd.Series(folders, dtype=object)
+        # Positions of the files of folder i: order[starts[i]:starts[i+1]]
+        self.order = np.argsort(codes, kind='stable')
+        self.starts = np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(folders)))))
+        self.nbytes = self.order.nbytes + self.starts.nbytes + int(self.folders.memory_usage(deep=True))
+
+    def rows(self, folder, recurse=False):
+        """ Positions (sorted) of the files whose folder ends with folder (case insensitive),
+        or, with recurse, of the files of any folder containing it
+        """
+        folder = folder.lower().rstrip('/') + '/'
+        if recurse:
+            matched = self.folders.str.contains(folder, regex=False)
+        else:
+            matched = self.folders.str.endswith(folder)
+        ranges = [self.order[self.starts[code]:self.starts[code + 1]] for code in np.flatnonzero(matched.to_numpy())]
+        return np.sort(np.concatenate(ranges)) if ranges else np.empty(0, dtype=np.intp)
+
+
+def unique_files_folder_analysis(exefs, thisexed_path, exef_intg_max_occs, compop='==', recurse=False, prevdays=0, tsfield='m', verbose=False, index=None):
+    """ Files of a folder (and its sub-folders with recurse) whose path is found a number
+    of times (compop exef_intg_max_occs) in the folder files of all the hosts
+
+    Parameters:
+    exefs (pd.DataFrame): Files, as read by read_fstls_filetypes()
+    thisexed_path (str): Folder to analyze (eg: windows/system32), case insensitive
+    exef_intg_max_occs (int): No. occurrences
+    compop (str): Comparison operator: < | > | == | >= | <=
+    recurse (bool): Include the files of the sub-folders
+    index (FstlFolderIndex): Folder index of exefs, built here if not given
+
+    Returns:
+    pd.DataFrame: Interesting files
+    """
+    compare = fstl_compops.get(compop)
+    if compare is None:
         print("Invalid Comparison Operator: "+compop)
         return False
 
-    regexrec=thisexed_path+"/"
-    regexnorec=thisexed_path+"/[^/]*$"
-
-    if recurse == True:
-        thisexefsrec=exefs[exefs['path'].str.contains(regexrec,case=False,regex=True)]
-        nexefsrec=len(thisexefsrec)
-        thisexefs=thisexefsrec
-        if verbose == True:
-            print("No. files (recursive):     "+str(nexefsrec)+"\n")
-    else:
-        thisexefsnorec=exefs[exefs['path'].str.contains(regexnorec,case=False,regex=True)]
-        nexefsnorec=len(thisexefsnorec)
-        thisexefs=thisexefsnorec
-        if verbose == True:
-            print("No. files (non-recursive): "+str(nexefsnorec)+"\n")
+    if index is None:
+        index = FstlFolderIndex(exefs)
+    thisexefs = exefs.iloc[index.rows(thisexed_path, recurse=recurse)]
+    if verbose == True:
+        if recurse == True:
+            print("No. files (recursive):     "+str(len(thisexefs))+"\n")
+        else:
+            print("No. files (non-recursive): "+str(len(thisexefs))+"\n")
 
     exefgrps = thisexefs.groupby('path-hash')
-    exefgrps_groups = exefgrps.groups
-    nexefgrps = len(exefgrps_groups)
-    exef_sizes=exefgrps.groups.keys()
-    exef_sizes_occs=exefgrps.size()
+    nexefgrps = exefgrps.ngroups
     if verbose:
         print("phash ANALYSIS - - - - - - - - - - - - - - - - - - - - - - - - - - - - - \n")
         print("RECURSION: "+str(recurse))
         print("No.groups: "+str(nexefgrps)+"\n")
 
     if prevdays == 0 :
-        exef_intg = exefgrps.filter(lambda x: eval( str(len(x)) + compop + str(exef_intg_max_occs)) )
+        exef_intg = thisexefs[compare(exefgrps['path-hash'].transform('size'), exef_intg_max_occs)]
     else:
         print("No. Interesting (no. occurrences <=" + str(exef_intg_max_occs) + "): " + str(nexef_intg) + "\n")
         lastmtime = exef_intg.sort_values(by="mtime").tail(1)['mtime']
@@ -158,10 +385,319 @@ def unique_files_folder_analysis(exefs, thisexed_path, exef_intg_max_occs, compo
 
     return exef_intg
 
+def fstl_path_groupings(exefs):
+    """ Groups of the files by path-hash, as used by unique_files_folder_analysis().
+    The path-hash is stable, so the groupings saved by different runs can be joined on it
+
+    Parameters:
+    exefs (pd.DataFrame): Files, as read by read_fstls_filetypes()
+
+    Returns:
+    pd.DataFrame: path-hash, path (first one found), occurrences, hosts
+    """
+    return exefs.groupby('path-hash').agg(path=('path', 'first'), occurrences=('path', 'size'), hosts=('host-vol', 'nunique')).reset_index()
+
+def save_fstl_path_groupings(groupings, filename):
+    """ Save the path groupings to filename (Parquet if it ends with .parquet, CSV otherwise) """
+    if filename.endswith('.parquet'):
+        groupings.to_parquet(filename, index=False)
+    else:
+        groupings.to_csv(filename, index=False)
+
+def unique_files_folder_analysis_dataset(datasetd, thisexed_path, exef_intg_max_occs, compop='==', recurse=False, file_types=['exe'], verbose=False):
+    """ unique_files_folder_analysis() on a dataset written by read_fstls_filetypes(dataset=...),
+    without loading it: a first pass counts, one batch at a time, the files of the folder by
+    path-hash, and a second one reads only the rows of the interesting path-hashes
+    (the file types are only read from their ext partitions)
+
+    Parameters:
+    datasetd (str): Dataset directory
+    file_types (list): File types analyzed (None: all)
+    (the other parameters are the ones of unique_files_folder_analysis())
+
+    Returns:
+    pd.DataFrame: Interesting files
+    """
+    import pyarrow.dataset
+    compare = fstl_compops.get(compop)
+    if compare is None:
+        print("Invalid Comparison Operator: "+compop)
+        return False
+
+    dataset = fstl_dataset(datasetd)
+    extfilter = fstl_dataset_filter(file_types)
+
+    # Pass 1: No. files of each path-hash of the folder. The batch counts are merged
+    # when they add up to more rows than the merged ones, so the work stays linear
+    occs = pd.Series(dtype='int64', index=pd.Index([], dtype='int64'))
+    batchoccs = []
+    nfiles = 0
+    for batch in dataset.to_batches(columns=['path', 'path-hash'], filter=extfilter):
+        batchdf = batch.to_pandas()
+        thisbatchdf = batchdf.iloc[FstlFolderIndex(batchdf).rows(thisexed_path, recurse=recurse)]
+        nfiles += len(thisbatchdf)
+        batchoccs.append(thisbatchdf['path-hash'].value_counts())
+        if sum(len(counts) for counts in batchoccs) > len(occs):
+            occs = pd.concat([occs] + batchoccs).groupby(level=0).sum()
+            batchoccs = []
+    occs = pd.concat([occs] + batchoccs).groupby(level=0).sum()
+    if verbose:
+        print("No. files (" + ("recursive" if recurse else "non-recursive") + "): " + str(nfiles) + "\n")
+        print("phash ANALYSIS - - - - - - - - - - - - - - - - - - - - - - - - - - - - - \n")
+        print("RECURSION: "+str(recurse))
+        print("No.groups: "+str(len(occs))+"\n")
+
+    # Pass 2: the files of the interesting path-hashes (a path-hash is a whole path,
+    # so they are all in the folder)
+    intghashes = occs.index[compare(occs, exef_intg_max_occs)].to_numpy(dtype='int64')
+    intgfilter = pyarrow.dataset.field('path-hash').isin(intghashes)
+    if extfilter is not None:
+        intgfilter = intgfilter & extfilter
+    exef_intg = dataset.to_table(filter=intgfilter).to_pandas()
+    # Parquet keeps the timestamps in ms
+    return exef_intg[fstl_hostname_names_hash].astype(fstl_tstamp_types)
+
+
+def fstl_size_top_n_dataset(datasetd, n, file_types=None):
+    """ Get top n max size files of a dataset written by read_fstls_filetypes(dataset=...),
+    one file of the dataset at a time. Once n files are found, only the row groups with
+    larger files are read
+
+    Parameters:
+    datasetd (str): Dataset directory
+    n (int): Number of desired results
+    file_types (list): File types analyzed (None: all)
+
+    Returns:
+    pd.DataFrame: Size, FileName
+    """
+    import pyarrow.dataset
+    dataset = fstl_dataset(datasetd)
+    top = pd.DataFrame({'Size': pd.Series(dtype='int64'), 'FileName': pd.Series(dtype=object)})
+    for fragment in dataset.get_fragments(filter=fstl_dataset_filter(file_types)):
+        sizefilter = pyarrow.dataset.field('fsize') >= int(top['Size'].min()) if len(top) >= n else None
+        chunk = fragment.to_table(columns=['fsize', 'path'], filter=sizefilter).to_pandas()
+        top = fstl_size_top_n_merge(top, chunk.rename(columns={'fsize': 'Size', 'path': 'FileName'}), n)
+    return top.reset_index(drop=True)
+
+
+# Prevalence store ------------------------------------------------------------
+# <stored>/store.json                          Shards, file types, generation of each shard, hosts added
+# <stored>/shard-NNN/paths-GGGGGG.parquet      path-hash, path, hosts, count, btime-min, mtime-max
+# <stored>/shard-NNN/sizes-GGGGGG.parquet      path-hash, fsize, hosts
+# The rows of a path-hash are in shard path-hash % shards. Adding hosts writes a new
+# generation of the shards they touch, and store.json is only replaced at the end.
+prevalence_paths_columns = ['path-hash', 'path', 'hosts', 'count', 'btime-min', 'mtime-max']
+prevalence_paths_aggs = {'path': 'first', 'hosts': 'sum', 'count': 'sum', 'btime-min': 'min', 'mtime-max': 'max'}
+
+
+def prevalence_store_open(stored, file_types=None, shards=64):
+    """ Metadata of the prevalence store of directory stored (a new, empty, one if it does not exist)
+
+    Parameters:
+    stored (str): Store directory
+    file_types (list): File types (extensions) kept in the store, only used for a new store
+    shards (int): No. shards, only used for a new store
+
+    Returns:
+    dict: shards, file_types, generations (of each shard, 0: empty), hosts ({host: {'files', 'added'}})
+    """
+    metaf = os.path.join(stored, 'store.json')
+    if os.path.isfile(metaf):
+        with open(metaf) as f:
+            meta = json.load(f)
+        if file_types is not None and sorted(file_types) != sorted(meta['file_types']):
+            raise ValueError("The store " + stored + " keeps the file types " + ", ".join(meta['file_types']))
+        return meta
+    return {'version': 1, 'shards': shards, 'file_types': file_types or ['exe'], 'generations': [0] * shards, 'hosts': {}}
+
+
+def prevalence_store_save(stored, meta):
+    """ Replace the metadata of the store at once, so it never points to half written shards """
+    metaf = os.path.join(stored, 'store.json')
+    with open(metaf + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(metaf + '.tmp', metaf)
+
+
+def prevalence_shard_file(stored, table, shard, generation):
+    return os.path.join(stored, 'shard-%03d' % shard, '%s-%06d.parquet' % (table, generation))
+
+
+def prevalence_hosts_parts(fstld, hosts, file_types, shards, stagingd, batchno, engine='c'):
+    """ Reduce the files of each host of a batch to one row per path-hash (and per path-hash
+    and size), merge the rows of the batch and write them to the staging directory, split
+    by shard: one file per batch, shard and table, not per host.
+    Runs in the worker processes of prevalence_add()
+
+    Returns:
+    dict: {host: No. files of the host kept}
+    """
+    nfiles = {}
+    pathsdfs, sizesdfs = [], []
+    for host in hosts:
+        nlines, thisdfs = read_fstl_host_filetypes(fstld, host, file_types, engine)
+        files = pd.concat(thisdfs.values())
+        paths = files.groupby('path-hash', sort=False).agg(
+            **{'path': ('path', 'first'), 'count': ('path', 'size'), 'btime-min': ('btime', 'min'), 'mtime-max': ('mtime', 'max')}).reset_index()
+        paths.insert(2, 'hosts', 1)
+        pathsdfs.append(paths)
+        sizes = files[['path-hash', 'fsize']].drop_duplicates()
+        sizes['hosts'] = 1
+        sizesdfs.append(sizes)
+        nfiles[host] = len(files)
+    paths = pd.concat(pathsdfs).groupby('path-hash', sort=False).agg(prevalence_paths_aggs).reset_index()
+    sizes = pd.concat(sizesdfs).groupby(['path-hash', 'fsize'], sort=False)['hosts'].sum().reset_index()
+    for table, tabledf in (('paths', paths), ('sizes', sizes)):
+        tableshards = tabledf['path-hash'].to_numpy().view('uint64') % shards
+        for shard, sharddf in tabledf.groupby(tableshards):
+            sharddf.to_parquet(os.path.join(stagingd, 'shard-%03d' % shard, '%s-%06d.parquet' % (table, batchno)), index=False)
+    return nfiles
+
+
+def prevalence_shard_merge(stored, shard, generation, newgeneration, stagingd):
+    """ Write the new generation of a shard: its previous rows plus the staged ones """
+    os.makedirs(os.path.join(stored, 'shard-%03d' % shard), exist_ok=True)
+    for table in ('paths', 'sizes'):
+        tablefs = sorted(glob.glob(os.path.join(stagingd, 'shard-%03d' % shard, table + '-*.parquet')))
+        if generation:
+            tablefs.insert(0, prevalence_shard_file(stored, table, shard, generation))
+        tabledf = pd.concat([pd.read_parquet(tablef) for tablef in tablefs], ignore_index=True)
+        if table == 'paths':
+            # Sorted by hosts, so the row group statistics skip most of the shard when querying
+            tabledf = tabledf.groupby('path-hash', sort=False).agg(prevalence_paths_aggs).reset_index().sort_values('hosts', kind='stable')
+        else:
+            tabledf = tabledf.groupby(['path-hash', 'fsize'], sort=False)['hosts'].sum().reset_index()
+        tabledf.to_parquet(prevalence_shard_file(stored, table, shard, newgeneration), index=False)
+
+
+def prevalence_add(stored, fstld, hosts, file_types=None, shards=64, verbose=False, workers=1, engine='c', batch_size=64):
+    """ Add the bodyfiles (<fstld>/<host>/fstlmaster.body.raw) of the hosts that are not in the
+    prevalence store yet. Only the shards are read again, not the bodyfiles already added.
+
+    Parameters:
+    stored (str): Store directory (created if it does not exist)
+    fstld (str): Directory with the host folders
+    hosts (list): Hosts to add
+    file_types (list): File types kept, for a new store (default: exe)
+    shards (int): No. shards, for a new store
+    workers (int): Read the hosts with N worker processes
+    engine (str): CSV reader of read_bodyfile() ('c' or 'pyarrow')
+    batch_size (int): Hosts read and staged together by each worker task
+
+    Returns:
+    dict: Metadata of the store
+    """
+    meta = prevalence_store_open(stored, file_types, shards)
+    newhosts = [host for host in hosts if host not in meta['hosts']]
+    print("- Hosts already in the store: " + str(len(hosts) - len(newhosts)))
+    print("- Hosts to add: " + str(len(newhosts)))
+    if not newhosts:
+        return meta
+
+    stagingd = os.path.join(stored, 'staging')
+    shutil.rmtree(stagingd, ignore_errors=True)
+    for shard in range(meta['shards']):
+        os.makedirs(os.path.join(stagingd, 'shard-%03d' % shard))
+
+    start_time = time.time()
+    args = (meta['file_types'], meta['shards'], stagingd)
+    # The hosts are staged in batches, so the staging files are batches x shards, not
+    # hosts x shards. Smaller batches when there are few hosts, to keep all the workers busy
+    step = max(1, min(batch_size, -(-len(newhosts) // workers)))
+    batches = [newhosts[first:first + step] for first in range(0, len(newhosts), step)]
+    added = {}
+    with fstl_pool(workers) as pool:
+        if pool is not None:
+            futures = [pool.submit(prevalence_hosts_parts, fstld, batch, *args, batchno, engine) for batchno, batch in enumerate(batches)]
+            results = (future.result() for future in concurrent.futures.as_completed(futures))
+        else:
+            results = (prevalence_hosts_parts(fstld, batch, *args, batchno, engine) for batchno, batch in enumerate(batches))
+
+        for nfiles in results:
+            for host in nfiles:
+                added[host] = {'files': nfiles[host], 'added': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                if verbose:
+                    print("  + [" + str(len(added)) + "/" + str(len(newhosts)) + "] Read host: " + host + " (" + str(nfiles[host]) + " files)")
+
+    newgeneration = max(meta['generations']) + 1
+    oldgenerations = list(meta['generations'])
+    for shard in range(meta['shards']):
+        if os.listdir(os.path.join(stagingd, 'shard-%03d' % shard)):
+            prevalence_shard_merge(stored, shard, meta['generations'][shard], newgeneration, stagingd)
+            meta['generations'][shard] = newgeneration
+    meta['hosts'].update(added)
+    prevalence_store_save(stored, meta)
+
+    # The store is consistent again, the replaced generations can go
+    for shard, generation in enumerate(oldgenerations):
+        if generation and generation != meta['generations'][shard]:
+            for table in ('paths', 'sizes'):
+                os.remove(prevalence_shard_file(stored, table, shard, generation))
+    shutil.rmtree(stagingd)
+
+    if verbose:
+        print("- Elapsed time: " + str(time.time() - start_time))
+    print("- Hosts in the store: " + str(len(meta['hosts'])))
+    return meta
+
+
+def prevalence_query(stored, nhosts, compop='<=', path=None, recurse=False, sizes=False):
+    """ Paths of the prevalence store found in a number of hosts (compop nhosts),
+    without reading any bodyfile
+
+    Parameters:
+    stored (str): Store directory
+    nhosts (int): No. hosts
+    compop (str): Comparison operator: < | > | == | >= | <=
+    path (str): Only the files of this folder (eg: windows/system32), case insensitive
+    recurse (bool): Include the files of the sub-folders of path
+    sizes (bool): Add the list of the different sizes of each path
+
+    Returns:
+    pd.DataFrame: path-hash, path, hosts, count, btime-min, mtime-max (, sizes)
+    """
+    if compop not in fstl_compops:
+        raise ValueError("Invalid Comparison Operator: " + compop)
+    meta = prevalence_store_open(stored)
+    shardfs = [(shard, generation) for shard, generation in enumerate(meta['generations']) if generation]
+    found = [pd.read_parquet(prevalence_shard_file(stored, 'paths', shard, generation), filters=[('hosts', compop, nhosts)])
+             for shard, generation in shardfs]
+    found = pd.concat(found, ignore_index=True) if found else pd.DataFrame(columns=prevalence_paths_columns)
+    if path is not None:
+        found = found.iloc[FstlFolderIndex(found).rows(path, recurse=recurse)]
+    if sizes:
+        foundsizes = []
+        for shard, generation in shardfs:
+            sizesdf = pd.read_parquet(prevalence_shard_file(stored, 'sizes', shard, generation), columns=['path-hash', 'fsize'])
+            foundsizes.append(sizesdf[sizesdf['path-hash'].isin(found['path-hash'])])
+        foundsizes = pd.concat(foundsizes).groupby('path-hash')['fsize'].agg(sorted) if foundsizes else pd.Series(dtype=object)
+        found = found.assign(sizes=found['path-hash'].map(foundsizes))
+    return found.sort_values(['hosts', 'count', 'path'], kind='stable').reset_index(drop=True)
+
+
 def cmd_unique_files_folder_analysis(args):
+    if args.dataset:
+        results = unique_files_folder_analysis_dataset(args.fstl_hosts_directory, args.analysis_path, args.ocurrences, compop=args.compop, recurse=args.recurse, verbose=args.verbose)
+        print(results)
+        return
     hosts = os.listdir(args.fstl_hosts_directory)
-    fsdf = read_fstls_filetypes(args.fstl_hosts_directory, hosts, ['exe'], verbose=args.verbose)
-    results = unique_files_folder_analysis(fsdf['exe'], args.analysis_path, args.ocurrences, compop=args.compop, verbose=args.verbose)  
+    fsdf = read_fstls_filetypes(args.fstl_hosts_directory, hosts, ['exe'], verbose=args.verbose, workers=args.workers, engine=args.engine)
+    results = unique_files_folder_analysis(fsdf['exe'], args.analysis_path, args.ocurrences, compop=args.compop, recurse=args.recurse, verbose=args.verbose)  
+    print(results)
+    if args.groupings:
+        save_fstl_path_groupings(fstl_path_groupings(fsdf['exe']), args.groupings)
+
+def cmd_fstl_dataset_write(args):
+    hosts = sorted(os.listdir(args.fstl_hosts_directory))
+    read_fstls_filetypes(args.fstl_hosts_directory, hosts, args.file_types, verbose=args.verbose, workers=args.workers, engine=args.engine, dataset=args.dataset_directory)
+
+def cmd_prevalence_add(args):
+    hosts = sorted(os.listdir(args.fstl_hosts_directory))
+    prevalence_add(args.store_directory, args.fstl_hosts_directory, hosts, file_types=args.file_types, shards=args.shards, verbose=args.verbose, workers=args.workers, engine=args.engine)
+
+def cmd_prevalence_query(args):
+    results = prevalence_query(args.store_directory, args.hosts, compop=args.compop, path=args.path, recurse=args.recurse, sizes=args.sizes)
     print(results)
 
 if __name__ == "__main__":
@@ -176,6 +712,9 @@ if __name__ == "__main__":
     cmd_fstl_size_top_n_parser.add_argument("fstl_file", type=str, help='FSTL file')
     cmd_fstl_size_top_n_parser.add_argument("n", type=int, help='Number of desired results' )
     cmd_fstl_size_top_n_parser.add_argument("-w", "--windows", action="store_true", help='The FSTL file is from windows hosts' )
+    cmd_fstl_size_top_n_parser.add_argument("-s", "--stream", action="store_true", help='Read the FSTL file in chunks, keeping only the top n files in memory' )
+    cmd_fstl_size_top_n_parser.add_argument("-d", "--dataset", action="store_true", help='fstl_file is a dataset directory written by fstl_dataset_write' )
+    cmd_fstl_size_top_n_parser.add_argument("--chunksize", type=int, default=1000000, help='Lines read at a time with --stream (default: 1000000)' )
     cmd_fstl_size_top_n_parser.set_defaults(func=cmd_fstl_size_top_n)
 
     cmd_unique_files_folder_analysis_parser = subparsers.add_parser('unique_files_folder_analysis', help="Get exe files found with a number of occurrences in systems")
@@ -183,9 +722,42 @@ if __name__ == "__main__":
     cmd_unique_files_folder_analysis_parser.add_argument("analysis_path", type=str, help='Path to analyze (eg: windows/system32)')
     cmd_unique_files_folder_analysis_parser.add_argument("ocurrences", type=int, help='ocurrences of a file')
     cmd_unique_files_folder_analysis_parser.add_argument("-c", "--compop", type=str, default="<=", help='Compare ocurrences: < | > | == | >= | <=  (default: <=)')
+    cmd_unique_files_folder_analysis_parser.add_argument("-r", "--recurse", action="store_true", help='Include the files of the sub-folders')
     cmd_unique_files_folder_analysis_parser.add_argument("-v", "--verbose", action="store_true", help='shows more info')
+    cmd_unique_files_folder_analysis_parser.add_argument("--workers", type=int, default=1, help='Read the hosts fstl files with N worker processes (default: 1)')
+    cmd_unique_files_folder_analysis_parser.add_argument("--engine", type=str, default="c", choices=["c", "pyarrow"], help='CSV reader of the fstl files, pyarrow is faster (default: c)')
+    cmd_unique_files_folder_analysis_parser.add_argument("-d", "--dataset", action="store_true", help='fstl_hosts_directory is a dataset directory written by fstl_dataset_write')
+    cmd_unique_files_folder_analysis_parser.add_argument("-g", "--groupings", type=str, help='Save the groupings of the exe files by path-hash to this file (.parquet or .csv), not with --dataset')
 
     cmd_unique_files_folder_analysis_parser.set_defaults(func=cmd_unique_files_folder_analysis)
+
+    cmd_fstl_dataset_write_parser = subparsers.add_parser('fstl_dataset_write', help="Write the hosts fstl files to a Parquet dataset partitioned by host and extension")
+    cmd_fstl_dataset_write_parser.add_argument("dataset_directory", type=str, help='Dataset directory (hosts already in it are written again)')
+    cmd_fstl_dataset_write_parser.add_argument("fstl_hosts_directory", type=str, help='directory wiht host folders that contains fstl files')
+    cmd_fstl_dataset_write_parser.add_argument("--file_types", type=str, nargs='+', help='File types (extensions) written (default: all)')
+    cmd_fstl_dataset_write_parser.add_argument("-v", "--verbose", action="store_true", help='shows more info')
+    cmd_fstl_dataset_write_parser.add_argument("--workers", type=int, default=1, help='Read the hosts fstl files with N worker processes (default: 1)')
+    cmd_fstl_dataset_write_parser.add_argument("--engine", type=str, default="c", choices=["c", "pyarrow"], help='CSV reader of the fstl files, pyarrow is faster (default: c)')
+    cmd_fstl_dataset_write_parser.set_defaults(func=cmd_fstl_dataset_write)
+
+    cmd_prevalence_add_parser = subparsers.add_parser('prevalence_add', help="Add the hosts not added yet to a prevalence store")
+    cmd_prevalence_add_parser.add_argument("store_directory", type=str, help='Prevalence store directory (created if it does not exist)')
+    cmd_prevalence_add_parser.add_argument("fstl_hosts_directory", type=str, help='directory wiht host folders that contains fstl files')
+    cmd_prevalence_add_parser.add_argument("--file_types", type=str, nargs='+', help='File types (extensions) kept in a new store (default: exe)')
+    cmd_prevalence_add_parser.add_argument("--shards", type=int, default=64, help='No. shards of a new store (default: 64)')
+    cmd_prevalence_add_parser.add_argument("-v", "--verbose", action="store_true", help='shows more info')
+    cmd_prevalence_add_parser.add_argument("--workers", type=int, default=1, help='Read the hosts fstl files with N worker processes (default: 1)')
+    cmd_prevalence_add_parser.add_argument("--engine", type=str, default="c", choices=["c", "pyarrow"], help='CSV reader of the fstl files, pyarrow is faster (default: c)')
+    cmd_prevalence_add_parser.set_defaults(func=cmd_prevalence_add)
+
+    cmd_prevalence_query_parser = subparsers.add_parser('prevalence_query', help="Get the files of a prevalence store found in a number of hosts")
+    cmd_prevalence_query_parser.add_argument("store_directory", type=str, help='Prevalence store directory')
+    cmd_prevalence_query_parser.add_argument("hosts", type=int, help='No. hosts where a file is found')
+    cmd_prevalence_query_parser.add_argument("-c", "--compop", type=str, default="<=", help='Compare no. hosts: < | > | == | >= | <=  (default: <=)')
+    cmd_prevalence_query_parser.add_argument("-p", "--path", type=str, help='Only files of this path (eg: windows/system32)')
+    cmd_prevalence_query_parser.add_argument("-r", "--recurse", action="store_true", help='Include the files of the sub-folders of path')
+    cmd_prevalence_query_parser.add_argument("-s", "--sizes", action="store_true", help='Show the different sizes of each file')
+    cmd_prevalence_query_parser.set_defaults(func=cmd_prevalence_query)
     
     args = parser.parse_args()
     try:
@@ -203,5 +775,20 @@ if __name__ == "__main__":
         print(80 * "-")
 
         cmd_unique_files_folder_analysis_parser.print_help()
+        print()
+        print(80 * "-")
+        print("    Command: fstl_dataset_write - Write the hosts fstl files to a Parquet dataset partitioned by host and extension")
+        print(80 * "-")
+        cmd_fstl_dataset_write_parser.print_help()
+        print()
+        print(80 * "-")
+        print("    Command: prevalence_add - Add the hosts not added yet to a prevalence store")
+        print(80 * "-")
+        cmd_prevalence_add_parser.print_help()
+        print()
+        print(80 * "-")
+        print("    Command: prevalence_query - Get the files of a prevalence store found in a number of hosts")
+        print(80 * "-")
+        cmd_prevalence_query_parser.print_help()
         parser.exit()
     
\ No newline at end of file
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+__copyright__ = "Copyright 2020, DS4N6 Project"
+__credits__ = ["Jess Garcia"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Jess Garcia"
+__email__ = "ds4n6@one-esecurity.com"
+"""
+# python IMPORTS
+import os
+import glob
+import hashlib
+import sys
+import io
+import argparse
+import contextlib
+import importlib.util
+from collections import OrderedDict
+from collections.abc import Mapping
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# DS IMPORTS
+import pandas as pd
+
+
+def load_script(name):
+    """
+    Import one of the ds4n6-analysis_*.py scripts of this directory as a module.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), name + ".py")
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    # Registered before running it, so its functions can be pickled (--workers)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+evtx = load_script('ds4n6-analysis_evtx')
+fstl = load_script('ds4n6-analysis_fstl')
+volatility = load_script('ds4n6-analysis_volatility')
+
+
+def path_stamp(path):
+    """
+    (size, mtime) of a file, so a dataset is loaded again when its file changes.
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def paths_stamp(paths):
+    """
+    Digest of the (path, size, mtime) of a set of files, so a dataset read from a
+    directory is loaded again when a file is added, removed or changed.
+    """
+    stamps = [(path, path_stamp(path)) for path in sorted(paths)]
+    return hashlib.sha1(repr(stamps).encode('utf-8')).hexdigest()[:16]
+
+
+def evidence_path(root, path):
+    """
+    Absolute path of an evidence named in a query (relative paths are taken from
+    root). Paths outside root, once .. and symlinks are resolved, are refused.
+    """
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise PermissionError("Not in the evidence root: " + path)
+    return full
+
+
+def dataset_size(data):
+    """
+    Memory used by a loaded dataset (dataframe, mapping or tuple of them), in bytes.
+    """
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    if isinstance(data, evtx.EvtxDfs):
+        return dataset_size(data.evtalldf) + sum(dataset_size(df) for df in data.dfs.values())
+    if isinstance(data, fstl.FstlFolderIndex):
+        return data.nbytes
+    if isinstance(data, Mapping):
+        return sum(dataset_size(df) for df in data.values())
+    if isinstance(data, tuple):
+        return sum(dataset_size(part) for part in data)
+    return 0
+
+
+class Datasets:
+    """
+    Datasets loaded by the queries, kept in memory until they take more than
+    budget bytes (least recently used ones are dropped first). Each dataset
+    also keeps the answers of the queries already run on it, so repeating a
+    query does not run the analysis again.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+
+    def size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def get(self, key, load):
+        entry = self.entries.get(key)
+        if entry is None:
+            print("  + Loading " + str(key))
+            data = load()
+            entry = self.entries[key] = {'data': data, 'size': dataset_size(data), 'answers': {}}
+        self.entries.move_to_end(key)
+        self.evict()
+        return entry
+
+    def answer(self, key, query, run):
+        """
+        Answer of query on the dataset of key, running it (run(data)) only
+        the first time.
+        """
+        entry = self.entries[key]
+        if query not in entry['answers']:
+            answer = run(entry['data'])
+            entry['answers'][query] = answer
+            # Per-EventID dataframes are only built when an analysis needs them
+            entry['size'] = dataset_size(entry['data']) + sum(len(text) for text in entry['answers'].values())
+            self.evict()
+        return entry['answers'][query]
+
+    def evict(self):
+        # The most recently used dataset is always kept
+        while len(self.entries) > 1 and self.size() > self.budget:
+            key, entry = self.entries.popitem(last=False)
+            print("  - Evicting " + str(key) + " (%.1f MB)" % (entry['size'] / 2**20))
+
+    def describe(self):
+        lines = ["%-80s %10.1f MB %5d answers" % (key, entry['size'] / 2**20, len(entry['answers']))
+                 for key, entry in self.entries.items()]
+        lines.append("Total: %.1f MB of %.1f MB" % (self.size() / 2**20, self.budget / 2**20))
+        return "\n".join(lines) + "\n"
+
+
+def captured(run, *args):
+    """
+    Run an analysis and return what it printed, followed by its result.
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = run(*args)
+        if result is not None:
+            print(result)
+    return output.getvalue()
+
+
+def load_evtx(evtxf, evtxfs):
+    if not evtxfs:
+        raise ValueError("No event log files: " + evtxf)
+    if os.path.isfile(evtxf):
+        return evtx.read_evtx(evtxf, verbose=False, cache=True)
+    return evtx.read_evtx_batch(evtxfs, verbose=False, cache=True)
+
+
+# Not answered by the server: string_search_file reads its terms from any file
+evtx_server_analyses = [analysis for analysis in evtx.evtx_analyses_nargs if analysis != 'string_search_file']
+
+
+def query_evtx(server, analysis, params):
+    """
+    /evtx/<analysis>?file=<evtx file, directory or glob>&arg=...&arg=...
+    Runs the analysis of ds4n6-analysis_evtx.py with the arguments of its
+    command line option (e.g. /evtx/id_stats?file=Security.evtx&arg=4624).
+    nonsysusers_graph writes its graph to the output directory of the server,
+    with the file name of its last argument.
+    """
+    evtxf = evidence_path(server.root, params['file'][-1])
+    evtxfs = [evidence_path(server.root, thisevtxf) for thisevtxf in evtx.evtx_files(evtxf)]
+    args = params.get('arg', [])
+    if analysis not in evtx_server_analyses:
+        raise KeyError(analysis)
+    if len(args) != evtx.evtx_analyses_nargs[analysis]:
+        raise ValueError("%s takes %d arguments" % (analysis, evtx.evtx_analyses_nargs[analysis]))
+    if analysis == 'nonsysusers_graph':
+        if not os.path.basename(args[2]):
+            raise ValueError("No graph file name: " + args[2])
+        args = args[:2] + [os.path.join(server.output_dir, os.path.basename(args[2]))]
+    options = argparse.Namespace(evtxf=evtxf, search_index=False, no_cache=False, cache_dir=evtx.evtx_cache_dir,
+                                 graph_density='density' in params, graph_bins=500, graph_max_keys=100)
+
+    def run(evts):
+        result = evtx.evtx_analysis_run(evts, analysis, args, options)
+        evtx.evtx_analysis_output(analysis, result)
+
+    key = ('evtx', evtxf, path_stamp(evtxf) if os.path.isfile(evtxf) else paths_stamp(evtxfs))
+    entry = server.datasets.get(key, lambda: load_evtx(evtxf, evtxfs))
+    if analysis == 'nonsysusers_graph':
+        # Run every time: the answer is the graph file written
+        return captured(run, entry['data'])
+    return server.datasets.answer(key, (analysis, tuple(args), options.graph_density), lambda evts: captured(run, evts))
+
+
+def load_fstls(fstld):
+    """
+    exe files of the hosts of fstld, with their folder index, so each folder
+    queried only looks at its own files.
+    """
+    exefs = fstl.read_fstls_filetypes(fstld, os.listdir(fstld), ['exe'])['exe']
+    return exefs, fstl.FstlFolderIndex(exefs)
+
+
+def query_fstl(server, analysis, params):
+    """
+    /fstl/fstl_size_top_n?file=<fstl file>&n=<n>[&windows]
+    /fstl/unique_files_folder_analysis?dir=<hosts dir>&path=<path>&occurrences=<n>[&compop=<=][&recurse]
+    """
+    if analysis == 'fstl_size_top_n':
+        fstlf, windows, n = evidence_path(server.root, params['file'][-1]), 'windows' in params, int(params['n'][-1])
+        key = ('fstl', fstlf, windows, path_stamp(fstlf))
+        server.datasets.get(key, lambda: fstl.read_fstl(fstlf, windows=windows))
+        return server.datasets.answer(key, (analysis, n), lambda fstldf: captured(fstl.fstl_size_top_n, fstldf, n))
+    if analysis == 'unique_files_folder_analysis':
+        fstld = evidence_path(server.root, params['dir'][-1])
+        path, occurrences = params['path'][-1], int(params['occurrences'][-1])
+        compop, recurse = params.get('compop', ['<='])[-1], 'recurse' in params
+
+        def run(exefs, index):
+            return fstl.unique_files_folder_analysis(exefs, path, occurrences, compop, recurse=recurse, index=index)
+
+        fstlfs = [evidence_path(server.root, os.path.join(fstld, host, 'fstlmaster.body.raw')) for host in os.listdir(fstld)]
+        key = ('fstls', fstld, paths_stamp(fstlfs))
+        server.datasets.get(key, lambda: load_fstls(fstld))
+        return server.datasets.answer(key, (analysis, path, occurrences, compop, recurse), lambda data: captured(run, *data))
+    raise KeyError(analysis)
+
+
+def query_volatility(server, analysis, params):
+    """
+    /volatility/pslist_boot_time_anomaly_analysis?dir=<dir>&prefix=<prefix>&ext=<ext>[&secs=30]
+    /volatility/processes_parent_analysis?dir=<dir>&prefix=<prefix>&ext=<ext>[&critical]
+    """
+    evd, prefix, ext = evidence_path(server.root, params['dir'][-1]), params['prefix'][-1], params['ext'][-1]
+    volfsf = [evidence_path(server.root, volff) for volff in glob.glob(evd + "/*/*" + ext)]
+    key = ('volatility', evd, prefix, ext, paths_stamp(volfsf))
+    if analysis == 'pslist_boot_time_anomaly_analysis':
+        secs = int(params.get('secs', [30])[-1])
+        run = lambda dfs: captured(volatility.volatility_pslist_boot_time_anomaly_analysis, dfs['pslist'], secs)
+        query = (analysis, secs)
+    elif analysis == 'processes_parent_analysis':
+        critical = 'critical' in params
+        run = lambda dfs: captured(volatility.volatility_processes_parent_analysis, dfs['pslist'], critical)
+        query = (analysis, critical)
+    else:
+        raise KeyError(analysis)
+    server.datasets.get(key, lambda: volatility.read_volatility(evd, prefix, ext))
+    return server.datasets.answer(key, query, run)
+
+
+queries = {
+    'evtx': query_evtx,
+    'fstl': query_fstl,
+    'volatility': query_volatility,
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    GET /<evtx|fstl|volatility>/<analysis>?<parameters> runs an analysis,
+    GET /datasets lists the datasets in memory. Answers are plain text.
+    Only requests addressed to the server by its localhost name are answered,
+    so a web page (or a DNS rebinding host) can't query it.
+    """
+
+    def do_GET(self):
+        port = self.server.server_address[1]
+        if self.headers.get('Host') not in ('127.0.0.1:%d' % port, 'localhost:%d' % port):
+            self.reply(403, "Forbidden host: " + str(self.headers.get('Host')) + "\n")
+            return
+        url = urlparse(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        parts = url.path.strip('/').split('/')
+        try:
+            if parts == ['datasets']:
+                self.reply(200, self.server.datasets.describe())
+            elif len(parts) == 2 and parts[0] in queries:
+                self.reply(200, queries[parts[0]](self.server, parts[1], params))
+            else:
+                self.reply(404, "Unknown query: " + url.path + "\n")
+        except KeyError as e:
+            self.reply(400, "Unknown analysis or missing parameter: " + str(e) + "\n")
+        except PermissionError as e:
+            self.reply(403, str(e) + "\n")
+        except (ValueError, OSError) as e:
+            self.reply(400, str(e) + "\n")
+        except Exception as e:
+            self.reply(500, "Query failed: " + type(e).__name__ + ": " + str(e) + "\n")
+
+    def reply(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.expand_frame_repr', False)
+    pd.set_option('max_colwidth', None)
+
+    parser = argparse.ArgumentParser(prog="ds4n6-analysis_server.py", description="Answer DS4N6 analyses over HTTP, keeping the parsed evidences in memory")
+    parser.add_argument('--port', metavar="port", action="store", type=int, default=8464, help="Port to listen on, on localhost (default: 8464)")
+    parser.add_argument('--memory_budget', metavar="MB", action="store", type=int, default=4096, help="Memory for the loaded evidences, least recently used ones are dropped first (default: 4096)")
+    parser.add_argument('--root', metavar="dir", action="store", required=True, help="Evidence root: the queries can only read files in this directory (relative paths are taken from it)")
+    parser.add_argument('--output_dir', metavar="dir", action="store", default=os.path.join(os.path.expanduser("~"), ".cache", "ds4n6", "server"), help="Directory the graphs are written to (default: ~/.cache/ds4n6/server)")
+    args = parser.parse_args()
+
+    print("DS4N6 Analysis Server v1.0\n")
+
+    server = HTTPServer(('127.0.0.1', args.port), QueryHandler)
+    server.datasets = Datasets(args.memory_budget * 2**20)
+    server.root = os.path.realpath(args.root)
+    server.output_dir = os.path.realpath(args.output_dir)
+    os.makedirs(server.output_dir, exist_ok=True)
+    print("+ Evidence root: " + server.root)
+    print("+ Graphs written to: " + server.output_dir)
+    print("+ Listening on http://127.0.0.1:%d/" % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -55,11 +55,11 @@ def read_volatility(evd, prefix, ext):
     volfsf = [f for f in glob.glob(evd + "/*/*" + ext)]
     # TODO: Use regex to include "^" & "$" instead of a vanilla replace
     cats = [os.path.basename(volff).replace(prefix, '').replace(ext, '') for volff in volfsf]
-    cats = np.unique(cats)
-    for cat in cats:
-            dfs[cat] = pd.DataFrame()
+    for cat in np.unique(cats):
             print('Reading csv files for category %-20s into dataframe ->  %-20s' % (cat, cat))
-            hostcatfs = [f for f in glob.glob(evd+"/*/" + prefix + cat + ext)]
+            hostcatfs = [volff for volff in volfsf if os.path.basename(volff) == prefix + cat + ext]
+            # Host dataframes are concatenated once, at the end
+            hostcatdfs = []
             for hostcatf in hostcatfs:
                 hostdfull = os.path.dirname(hostcatf)
                 host = os.path.basename(hostdfull)
@@ -77,7 +77,8 @@ def read_volatility(evd, prefix, ext):
                     hostcatlines['Sess'] = hostcatlines['Sess'].astype('int64')
                     hostcatlines['Wow64'] = hostcatlines['Wow64'].astype('int64')
                     hostcatlines['Exit'] = pd.to_datetime(hostcatlines['Exit'])
-                dfs[cat] = pd.concat([dfs[cat], hostcatlines], ignore_index=True)
+                hostcatdfs.append(hostcatlines)
+            dfs[cat] = pd.concat(hostcatdfs, ignore_index=True) if hostcatdfs else pd.DataFrame()
     print("\n\nNOTE: Now you can use the syntax <yourvar>['Category'] to access your dataframe")
     return dfs
 